@@ -102,8 +102,7 @@ ywidths = ywidths[keep_inds]
 
 # Normalize pld pixel values
 if method.lower() == 'pld':
-    pldints = [pix[keep_inds] for pix in pld_intensities]
-    pld_intensities = pld.normalize_pld(np.array(pldints))
+    pld_intensities = pld.ingest_pld(pld_intensities, keep_inds)
 
 # Normalize fluxes and flux errors around 1
 flux_errs = flux_errs/np.median(fluxes)
@@ -25,6 +25,8 @@ from .skywalker import *
 
 from . import utils
 from . import bliss
+from . import cache
+from . import kernels
 from . import krdata
 from . import pld
 from . import models
\ No newline at end of file
@@ -1,5 +1,6 @@
-from scipy import spatial
+from scipy import spatial, sparse
 from pylab import *;
+from . import kernels
 from . import utils
 
 def nearestIndices(xcenters, ycenters, knotTree):
@@ -13,6 +14,47 @@ def nearestIndices(xcenters, ycenters, knotTree):
         """
     return array([utils.nearest(xc,yc, 4, knotTree) for xc,yc in zip(xcenters, ycenters)])
 
+def regularGridIndices(xcenters, ycenters, knots, xBinSize, yBinSize):
+    """
+        Vectorized replacement for `nearestIndices` when the knots come from
+        `createGrid`. Each center is placed in its enclosing cell with floor
+        arithmetic and the 4 corners of that cell are returned, sorted from
+        nearest to farthest (the same convention as the KDTree query).
+        Centers past the last row/column of knots use the last full cell.
+
+        Args:
+        xcenters (array): array of x coordinates of each center.
+        ycenters (array): array of y coordinates of each center.
+        knots (array): array of lists with (x,y) coordinates of each vertex in the knot grid, as output by `createGrid`.
+        xBinSize (float): x length of each rectangle in the knot grid.
+        yBinSize (float): y length of each rectangle in the knot grid.
+        Returns:
+        array: (N, 4) array with the indices of the 4 corner knots of the cell enclosing each element in x/y-centers.
+        """
+    knots = np.asarray(knots)
+    xmin, ymin = knots[0]
+
+    # createGrid loops over x first, then y: knot index = ix * ny + iy
+    ny = np.count_nonzero(knots[:, 0] == xmin)
+    nx = len(knots) // ny
+    xknots = knots[::ny, 0]
+    yknots = knots[:ny, 1]
+
+    ix = np.clip(np.floor((xcenters - xmin) / xBinSize).astype(int), 0, max(nx - 2, 0))
+    iy = np.clip(np.floor((ycenters - ymin) / yBinSize).astype(int), 0, max(ny - 2, 0))
+    ix1 = np.minimum(ix + 1, nx - 1)
+    iy1 = np.minimum(iy + 1, ny - 1)
+
+    corners = np.transpose([ix * ny + iy, ix1 * ny + iy, ix * ny + iy1, ix1 * ny + iy1])
+
+    dx0 = (xcenters - xknots[ix])**2
+    dx1 = (xcenters - xknots[ix1])**2
+    dy0 = (ycenters - yknots[iy])**2
+    dy1 = (ycenters - yknots[iy1])**2
+    distances = np.transpose([dx0 + dy0, dx1 + dy0, dx0 + dy1, dx1 + dy1])
+
+    order = np.argsort(distances, axis=1, kind='stable')
+    return np.take_along_axis(corners, order, axis=1)
 
 def createGrid(xcenters, ycenters, xBinSize, yBinSize):
     """
@@ -21,10 +63,156 @@ def createGrid(xcenters, ycenters, xBinSize, yBinSize):
     :param yBinSize: y length of each rectangle in the knot grid.
     :return: array of lists with (x,y) coordinates of each vertex in knot grid.
     """
-    xmin, xmax = min(xcenters), max(xcenters)
-    ymin, ymax = min(ycenters), max(ycenters)
+    xmin, xmax = np.min(xcenters), np.max(xcenters)
+    ymin, ymax = np.min(ycenters), np.max(ycenters)
     return [(x, y) for x in arange(xmin, xmax, xBinSize) for y in arange(ymin, ymax, yBinSize)]
 
+def createQuadtreeGrid(xcenters, ycenters, xBinSize, yBinSize, minFrames=100):
+    """
+        Adaptive alternative to `createGrid` + `nearestIndices`.
+
+        The bounding box of the centers is recursively split into quadrants.
+        A cell is only split if every one of its non-empty quadrants would
+        hold at least minFrames centers, and never below xBinSize by
+        yBinSize. The knots are the corners of the leaf
+        cells, so densely sampled regions get a fine grid and the sparse
+        edges of the centroid distribution a coarse one.
+
+        The leaf cells have different sizes: use `cellSizes` to get the bin
+        sizes of each center for the interpolation (`BLISS` and
+        `BLISSOperator` do this when xBinSize/yBinSize are None).
+
+        Args:
+        xcenters (array): array of x coordinates of each center.
+        ycenters (array): array of y coordinates of each center.
+        xBinSize (float): smallest x length of a cell in the knot grid.
+        yBinSize (float): smallest y length of a cell in the knot grid.
+        minFrames (int): minimum number of centers in each non-empty cell produced by a split.
+        Returns:
+        knots (array): (M, 2) array with (x,y) coordinates of each vertex in the knot grid.
+        nearIndices (array): (N, 4) array with the indices of the 4 corner knots of the leaf cell of each center, nearest first.
+        """
+    xcenters = np.asarray(xcenters)
+    ycenters = np.asarray(ycenters)
+
+    xmin, ymin = xcenters.min(), ycenters.min()
+    width = max(xcenters.max() - xmin, xBinSize)
+    height = max(ycenters.max() - ymin, yBinSize)
+
+    maxDepth = int(max(np.ceil(np.log2(width / xBinSize)), np.ceil(np.log2(height / yBinSize)), 0))
+    nFinest = 2**maxDepth
+
+    # Integer coordinates of the finest cell holding each center
+    ixFine = np.clip((nFinest * (xcenters - xmin) / width).astype(np.int64), 0, nFinest - 1)
+    iyFine = np.clip((nFinest * (ycenters - ymin) / height).astype(np.int64), 0, nFinest - 1)
+
+    # Depth of the leaf cell holding each center
+    depth = np.full(len(xcenters), maxDepth, dtype=np.int64)
+    active = np.arange(len(xcenters))
+    for level in range(maxDepth):
+        shift = maxDepth - level
+        cells = (ixFine[active] >> shift) * 2**level + (iyFine[active] >> shift)
+        children = (ixFine[active] >> (shift - 1)) * 2**(level + 1) + (iyFine[active] >> (shift - 1))
+
+        _, cellInverse = np.unique(cells, return_inverse=True)
+        _, childInverse, childCounts = np.unique(children, return_inverse=True, return_counts=True)
+        cellInverse = cellInverse.ravel()
+
+        # Size of the smallest non-empty child of each cell
+        smallestChild = np.full(cellInverse.max() + 1, len(xcenters))
+        np.minimum.at(smallestChild, cellInverse, childCounts[childInverse.ravel()])
+
+        split = smallestChild[cellInverse] >= minFrames
+        depth[active[~split]] = level
+        active = active[split]
+
+        if not len(active): break
+
+    # Corners of each leaf cell, in units of the finest cells
+    shift = maxDepth - depth
+    ix0 = (ixFine >> shift) << shift
+    iy0 = (iyFine >> shift) << shift
+    ix1 = ix0 + (1 << shift)
+    iy1 = iy0 + (1 << shift)
+
+    nCorners = nFinest + 1
+    cornerKeys = np.transpose([ix0 * nCorners + iy0, ix1 * nCorners + iy0,
+                               ix0 * nCorners + iy1, ix1 * nCorners + iy1])
+
+    knotKeys, nearIndices = np.unique(cornerKeys, return_inverse=True)
+    nearIndices = nearIndices.reshape(cornerKeys.shape)
+
+    knots = np.transpose([xmin + (knotKeys // nCorners) * width / nFinest,
+                          ymin + (knotKeys % nCorners) * height / nFinest])
+
+    distances = (xcenters[:, None] - knots[nearIndices, 0])**2 + (ycenters[:, None] - knots[nearIndices, 1])**2
+    order = np.argsort(distances, axis=1, kind='stable')
+
+    return knots, np.take_along_axis(nearIndices, order, axis=1)
+
+def createVoxelGrid(xcenters, ycenters, npix, xBinSize, yBinSize, npBinSize):
+    """
+        3-D knot grid over (x, y, sqrt(npix)) for BLISS with a noise pixel
+        axis. Only the corners of the occupied voxels are stored, so the
+        number of knots scales with the volume the PSF actually samples.
+
+        Args:
+        xcenters (array): array of x coordinates of each center.
+        ycenters (array): array of y coordinates of each center.
+        npix (array): array of noise pixels of each center.
+        xBinSize (float): x length of each voxel in the knot grid.
+        yBinSize (float): y length of each voxel in the knot grid.
+        npBinSize (float): sqrt(npix) length of each voxel in the knot grid.
+        Returns:
+        knots (array): (M, 3) array with (x, y, sqrt(npix)) coordinates of each vertex in the knot grid.
+        nearIndices (array): (N, 8) array with the indices of the 8 corner knots of the voxel of each center, nearest first.
+        """
+    points = np.transpose([xcenters, ycenters, np.sqrt(npix)])
+    binSizes = np.array([xBinSize, yBinSize, npBinSize])
+    origin = points.min(axis=0)
+
+    cells = np.floor((points - origin) / binSizes).astype(np.int64)
+    nCorners = cells.max(axis=0) + 2
+
+    # Flattened index of each corner of each voxel
+    offsets = np.array([(i * nCorners[1] + j) * nCorners[2] + k for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+    cellKeys = (cells[:, 0] * nCorners[1] + cells[:, 1]) * nCorners[2] + cells[:, 2]
+    cornerKeys = cellKeys[:, None] + offsets[None, :]
+
+    knotKeys, nearIndices = np.unique(cornerKeys, return_inverse=True)
+    nearIndices = nearIndices.reshape(cornerKeys.shape)
+
+    knotCells = np.transpose([knotKeys // (nCorners[1] * nCorners[2]),
+                              (knotKeys // nCorners[2]) % nCorners[1],
+                              knotKeys % nCorners[2]])
+    knots = origin + knotCells * binSizes
+
+    distances = np.zeros(nearIndices.shape)
+    for axis in range(3):
+        distances += ((points[:, axis, None] - knots[nearIndices, axis]) / binSizes[axis])**2
+
+    order = np.argsort(distances, axis=1, kind='stable')
+
+    return knots, np.take_along_axis(nearIndices, order, axis=1)
+
+def cellSizes(knots, nearIndices):
+    """
+        Size of the cell spanned by the 4 nearest knots to each center; used
+        with knot grids of variable resolution (see `createQuadtreeGrid`).
+
+        Args:
+        knots (array): array of lists with (x,y) coordinates of each vertex in the knot grid.
+        nearIndices (array): array of arrays, each with the indices of the 4 nearest knots to each element in x/y-centers.
+        Returns:
+        xBinSizes (array): x length of the cell of each center.
+        yBinSizes (array): y length of the cell of each center.
+        """
+    knots = np.asarray(knots)
+    cornersX = knots[nearIndices, 0]
+    cornersY = knots[nearIndices, 1]
+
+    return cornersX.max(axis=1) - cornersX.min(axis=1), cornersY.max(axis=1) - cornersY.min(axis=1)
+
 def associateFluxes(knots, nearIndices, xcenters, ycenters, fluxes):
     """
     Args:
@@ -36,11 +224,41 @@ def associateFluxes(knots, nearIndices, xcenters, ycenters, fluxes):
     :return:
         Array with the mean flux associated with each knot of the grid.
     """
-    knot_fluxes = [[] for k in knots]
-    for kp in range(len(xcenters)):
-        N = nearIndices[kp][0]
-        knot_fluxes[N].append(fluxes[kp])
-    return [mean(flux) if len(flux) is not 0 else 0 for flux in knot_fluxes]
+    return accumulateFluxes(knots, nearIndices, fluxes)[0]
+
+def accumulateFluxes(knots, nearIndices, fluxes):
+    """
+        Grouped mean of the fluxes over their nearest knot, computed with
+        `bincount` in a single pass instead of per-knot Python lists.
+
+        `bincount` (and the numba kernel) add the fluxes sequentially, while
+        the per-knot `mean` of the original loop used numpy's pairwise
+        summation, so the means are not bit-for-bit identical to it: for
+        positive fluxes they agree to a relative (n - 1) * eps for a knot
+        with n points (~1e-15 for typical knots).
+
+        Args:
+        knots (array): array of lists with (x,y) coordinates of each vertex in the knot grid.
+        nearIndices (array): array of arrays, each with the indices of the 4 nearest knots to each element in x/y-centers.
+        fluxes (array): array of fluxes corresponding to each element in x/y-centers.
+        Returns:
+        knotFluxes (array): mean flux associated with each knot of the grid (0 for empty knots).
+        knotCounts (array): number of points associated with each knot of the grid.
+    """
+    nearest = np.asarray(nearIndices)[:, 0]
+    nKnots = len(knots)
+
+    if kernels.use_numba():
+        knotSums, knotCounts = kernels.knot_sums_and_counts(nearest, np.asarray(fluxes, dtype=float), nKnots)
+    else:
+        knotCounts = np.bincount(nearest, minlength=nKnots)
+        knotSums = np.bincount(nearest, weights=fluxes, minlength=nKnots)
+
+    knotFluxes = np.zeros(nKnots)
+    occupied = knotCounts > 0
+    knotFluxes[occupied] = knotSums[occupied] / knotCounts[occupied]
+
+    return knotFluxes, knotCounts
 
 def generate_deltaX_deltaY(xcenters, ycenters, knots, nearIndices):
     """
@@ -49,15 +267,15 @@ def generate_deltaX_deltaY(xcenters, ycenters, knots, nearIndices):
         :param knots: array of lists with (x,y) coordinates of each vertex in the knot grid.
         :param nearIndices: array of arrays, each with the indices of the 4 nearest knots to each element in y/x-centers.
     """
-    deltaX1 = zeros(len(xcenters))
-    deltaY1 = zeros(len(ycenters))
-    for kp, (xc,yc) in enumerate(zip(xcenters, ycenters)):
-        deltaX1[kp] = abs(xc - knots[nearIndices[kp][0]][0])
-        deltaY1[kp] = abs(yc - knots[nearIndices[kp][0]][1])
+    knots = np.asarray(knots)
+    nearest = np.asarray(nearIndices)[:, 0]
+
+    deltaX1 = abs(np.asarray(xcenters) - knots[nearest, 0])
+    deltaY1 = abs(np.asarray(ycenters) - knots[nearest, 1])
 
     return deltaX1, deltaY1
 
-def interpolateFlux(knots, knotFluxes, deltaX1, deltaY1, nearIndices, xBinSize, yBinSize, normFactor):
+def interpolateFlux(knots, knotFluxes, deltaX1, deltaY1, nearIndices, xBinSize, yBinSize, normFactor, emptyKnots=None):
     """
         Args:
         knots (array): array of lists with (x,y) coordinates of each vertex in the knot grid.
@@ -68,27 +286,39 @@ def interpolateFlux(knots, knotFluxes, deltaX1, deltaY1, nearIndices, xBinSize,
         xBinSize (float): x length of each rectangle in the knot grid.
         yBinSize (float): y length of each rectangle in the knot grid.
         normFactor (float): (1/xBinSize) * (1/yBinSize)
+        emptyKnots (array): boolean mask of the knots with no associated points (e.g. `knotCounts == 0`); if None, knots with zero flux are treated as empty.
         Returns:
-        array: array of interpolated flux at each point in x/y-centers.
+        array: array of interpolated flux at each point in x/y-centers; bit-for-bit identical to the original per-point loop for the same knot fluxes (see `accumulateFluxes` for the tolerance of the knot fluxes themselves).
     """
-    interpolated_fluxes = np.zeros(len(deltaX1))
-    for kp, (dx1,dy1) in enumerate(zip(deltaX1, deltaY1)):
-        nearest_fluxes = [knotFluxes[i] for i in nearIndices[kp]]
-        # If any knot has no flux, use nearest neighbor interpolation.
-        if 0 in nearest_fluxes:
-            N = nearIndices[kp][0]
-            interpolated_fluxes[kp] = knotFluxes[N]
-        # Else, do bilinear interpolation
-        else:
-            # Normalize distances with factor
-            # Interpolate
-            dx2 = xBinSize - dx1
-            dy2 = xBinSize - dy1
-
-            interpolated_fluxes[kp] = normFactor * (dx1 * dy2 * nearest_fluxes[0]
-                                                  + dx2 * dy2 * nearest_fluxes[1]
-                                                  + dx2 * dy1 * nearest_fluxes[2]
-                                                  + dx1 * dy1 * nearest_fluxes[3])
+    nearIndices = np.asarray(nearIndices)
+    knotFluxes = np.asarray(knotFluxes)
+
+    if emptyKnots is None:
+        emptyKnots = knotFluxes == 0
+
+    if kernels.use_numba() and np.ndim(xBinSize) == 0 and np.ndim(yBinSize) == 0 and np.ndim(normFactor) == 0:
+        return kernels.bilinear_interpolate(knotFluxes, np.asarray(emptyKnots), nearIndices,
+                                            np.asarray(deltaX1, dtype=float), np.asarray(deltaY1, dtype=float),
+                                            xBinSize, yBinSize, normFactor)
+
+    # (N, 4) array with the flux of the 4 nearest knots to each point
+    nearest_fluxes = knotFluxes[nearIndices]
+    fallback = np.asarray(emptyKnots)[nearIndices].any(axis=1)
+
+    dx1 = deltaX1
+    dy1 = deltaY1
+    dx2 = xBinSize - dx1
+    dy2 = yBinSize - dy1
+
+    # Bilinear interpolation
+    interpolated_fluxes = normFactor * (dx1 * dy2 * nearest_fluxes[:, 0]
+                                      + dx2 * dy2 * nearest_fluxes[:, 1]
+                                      + dx2 * dy1 * nearest_fluxes[:, 2]
+                                      + dx1 * dy1 * nearest_fluxes[:, 3])
+
+    # If any knot has no flux, use nearest neighbor interpolation.
+    interpolated_fluxes[fallback] = nearest_fluxes[fallback, 0]
+
     return interpolated_fluxes
 
 def BLISS(xcenters, ycenters, fluxes, knots, nearIndices, xBinSize=0.01, yBinSize=0.01, normFactor=10000):
@@ -99,13 +329,160 @@ def BLISS(xcenters, ycenters, fluxes, knots, nearIndices, xBinSize=0.01, yBinSiz
         fluxes (array): array of fluxes corresponding to each element in x/y-centers.
         knots (array): array of lists with (x,y) coordinates of each vertex in the knot grid.
         nearIndices (array): array of arrays, each with the indices of the 4 nearest knots to each element in x/y-centers.
-        xBinSize (float): x length of each rectangle in the knot grid.
-        yBinSize (float): y length of each rectangle in the knot grid.
+        xBinSize (float): x length of each rectangle in the knot grid; if None, computed per point with `cellSizes`.
+        yBinSize (float): y length of each rectangle in the knot grid; if None, computed per point with `cellSizes`.
         normFactor (float): (1/xBinSize) * (1/yBinSize)
         Returns:
         array: array of interpolated flux at each point in x/y-centers.
         """
-    meanKnotFluxes = associateFluxes(knots, nearIndices, xcenters, ycenters, fluxes)
+    if xBinSize is None or yBinSize is None:
+        xBinSize, yBinSize = cellSizes(knots, nearIndices)
+        normFactor = (1/xBinSize) * (1/yBinSize)
+
+    meanKnotFluxes, knotCounts = accumulateFluxes(knots, nearIndices, fluxes)
     deltaX1, deltaY1 = generate_deltaX_deltaY(xcenters, ycenters, knots, nearIndices)
 
-    return interpolateFlux(knots=knots, knotFluxes=meanKnotFluxes, deltaX1=deltaX1, deltaY1=deltaY1, nearIndices=nearIndices, xBinSize=xBinSize, yBinSize=yBinSize, normFactor=normFactor)
+    return interpolateFlux(knots=knots, knotFluxes=meanKnotFluxes, deltaX1=deltaX1, deltaY1=deltaY1, nearIndices=nearIndices, xBinSize=xBinSize, yBinSize=yBinSize, normFactor=normFactor, emptyKnots=knotCounts == 0)
+
+class BLISSOperator(object):
+    """
+        Precompiled BLISS map for a fixed set of centers, knots and nearIndices.
+
+        The centers, knots and nearIndices do not change during a fit, so the
+        knot averaging (`associateFluxes`) and the bilinear interpolation
+        (`interpolateFlux`) are both linear maps that only depend on them.
+        They are stored here as two sparse matrices, built once:
+
+            averaging     (nKnots x nPoints): mean flux of the points associated with each knot
+            interpolation (nPoints x nKnots): bilinear weights of the 4 nearest knots to each point
+
+        Calling the operator on a flux array returns the same map as `BLISS`,
+        at the cost of two sparse mat-vecs.
+
+        Args:
+        xcenters (array): array of x-coordinates of each center.
+        ycenters (array): array of y-coordinates of each center.
+        knots (array): array of lists with (x,y) coordinates of each vertex in the knot grid.
+        nearIndices (array): array of arrays, each with the indices of the 4 nearest knots to each element in x/y-centers.
+        xBinSize (float): x length of each rectangle in the knot grid; if None, computed per point with `cellSizes`.
+        yBinSize (float): y length of each rectangle in the knot grid; if None, computed per point with `cellSizes`.
+        normFactor (float): (1/xBinSize) * (1/yBinSize); computed from the bin sizes if None.
+    """
+    def __init__(self, xcenters, ycenters, knots, nearIndices, xBinSize=0.01, yBinSize=0.01, normFactor=None):
+        knots = np.asarray(knots)
+        nearIndices = np.asarray(nearIndices)
+
+        if xBinSize is None or yBinSize is None:
+            xBinSize, yBinSize = cellSizes(knots, nearIndices)
+            normFactor = None
+
+        if normFactor is None:
+            normFactor = (1/xBinSize) * (1/yBinSize)
+
+        # Same weights as `interpolateFlux`
+        deltaX1, deltaY1 = generate_deltaX_deltaY(xcenters, ycenters, knots, nearIndices)
+        deltaX2 = xBinSize - deltaX1
+        deltaY2 = yBinSize - deltaY1
+
+        weights = np.transpose(normFactor * np.array([deltaX1 * deltaY2, deltaX2 * deltaY2,
+                                                      deltaX2 * deltaY1, deltaX1 * deltaY1]))
+
+        self._compile(nearIndices, weights, len(knots))
+
+    def _compile(self, nearIndices, weights, nKnots):
+        """
+            Build the sparse averaging and interpolation matrices.
+
+            Args:
+            nearIndices (array): (N, nCorners) indices of the knots used by each point, nearest first.
+            weights (array): (N, nCorners) interpolation weights of those knots.
+            nKnots (int): number of knots in the grid.
+        """
+        nPoints, nCorners = nearIndices.shape
+        nearest = nearIndices[:, 0]
+        points = np.arange(nPoints)
+
+        # Each point contributes to the mean of its nearest knot only
+        self.counts = np.bincount(nearest, minlength=nKnots)
+        self.averaging = sparse.csr_matrix((1.0 / self.counts[nearest], (nearest, points)),
+                                           shape=(nKnots, nPoints))
+
+        # If any knot has no flux, use nearest neighbor interpolation.
+        fallback = (self.counts[nearIndices] == 0).any(axis=1)
+        weights[fallback] = 0.0
+        weights[fallback, 0] = 1.0
+
+        self.interpolation = sparse.csr_matrix((weights.ravel(), nearIndices.ravel(),
+                                                np.arange(0, nCorners * nPoints + 1, nCorners)),
+                                               shape=(nPoints, nKnots))
+        self.interpolation.eliminate_zeros()
+
+    def knotFluxes(self, fluxes):
+        """
+            Args:
+            fluxes (array): array of fluxes corresponding to each element in x/y-centers.
+            Returns:
+            array: mean flux associated with each knot of the grid.
+        """
+        return self.averaging.dot(fluxes)
+
+    def __call__(self, fluxes):
+        """
+            Args:
+            fluxes (array): array of fluxes corresponding to each element in x/y-centers.
+            Returns:
+            array: array of interpolated flux at each point in x/y-centers.
+        """
+        return self.interpolation.dot(self.averaging.dot(fluxes))
+
+class BLISS3DOperator(BLISSOperator):
+    """
+        `BLISSOperator` over (x, y, sqrt(npix)), with trilinear interpolation
+        between the 8 corners of the voxel of each center (see
+        `createVoxelGrid`). Points next to an empty knot use the nearest knot.
+
+        Args:
+        xcenters (array): array of x-coordinates of each center.
+        ycenters (array): array of y-coordinates of each center.
+        npix (array): array of noise pixels of each center.
+        knots (array): (M, 3) array with (x, y, sqrt(npix)) coordinates of each vertex in the knot grid.
+        nearIndices (array): (N, 8) array with the indices of the 8 corner knots of each center, nearest first.
+        xBinSize (float): x length of each voxel in the knot grid.
+        yBinSize (float): y length of each voxel in the knot grid.
+        npBinSize (float): sqrt(npix) length of each voxel in the knot grid.
+    """
+    def __init__(self, xcenters, ycenters, npix, knots, nearIndices, xBinSize=0.01, yBinSize=0.01, npBinSize=0.01):
+        knots = np.asarray(knots)
+        nearIndices = np.asarray(nearIndices)
+
+        points = np.transpose([xcenters, ycenters, np.sqrt(npix)])
+        binSizes = np.array([xBinSize, yBinSize, npBinSize])
+
+        # Trilinear weights: product over the axes of 1 - |distance| / binSize
+        weights = np.ones(nearIndices.shape)
+        for axis in range(3):
+            weights *= 1.0 - abs(points[:, axis, None] - knots[nearIndices, axis]) / binSizes[axis]
+
+        self._compile(nearIndices, weights, len(knots))
+
+def jointBLISSOperator(xcenters_list, ycenters_list, xBinSize=0.01, yBinSize=0.01):
+    """
+        Single BLISS map shared by several epochs. The knots are laid on one
+        global grid over the centers of every epoch, so frames of different
+        epochs that land on the same region of the pixel are pooled.
+
+        Args:
+        xcenters_list (list): arrays of x-coordinates of each center, one per epoch.
+        ycenters_list (list): arrays of y-coordinates of each center, one per epoch.
+        xBinSize (float): x length of each rectangle in the knot grid.
+        yBinSize (float): y length of each rectangle in the knot grid.
+        Returns:
+        BLISSOperator: operator acting on the concatenated fluxes of all epochs, in the order of the lists.
+    """
+    xcenters = np.concatenate(xcenters_list)
+    ycenters = np.concatenate(ycenters_list)
+
+    knots = createGrid(xcenters, ycenters, xBinSize, yBinSize)
+    nearIndices = regularGridIndices(xcenters, ycenters, knots, xBinSize, yBinSize)
+
+    return BLISSOperator(xcenters, ycenters, knots, nearIndices, xBinSize, yBinSize)
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+
+def artifact_key(*arrays, **params):
+    """
+        Content hash of a set of input arrays and scalar parameters.
+
+        Args:
+        arrays (nDarray): arrays that the cached artifacts depend on
+                            (e.g. xcenters, ycenters, keep_inds).
+        params: scalar settings that the cached artifacts depend on
+                            (e.g. x_bin_size=0.1, y_bin_size=0.1).
+        Returns:
+        str: hexadecimal sha1 digest identifying the inputs.
+    """
+    sha = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        sha.update('{}{}'.format(arr.dtype.str, arr.shape).encode())
+        sha.update(arr.view(np.uint8).ravel())
+
+    for name in sorted(params.keys()):
+        sha.update('{}={!r};'.format(name, params[name]).encode())
+
+    return sha.hexdigest()
+
+class ArtifactCache(object):
+    """
+        Content-addressed on-disk cache of numpy arrays.
+
+        Each entry is a directory named by its key (see `artifact_key`) that
+        holds one `.npy` file per array, so entries can be loaded as
+        memory-mapped arrays. The total size of the cache is bounded by
+        `max_bytes`; the least recently used entries are removed first.
+
+        Args:
+        cache_dir (str): directory in which to store the entries.
+        max_bytes (int): maximum total size of the cache on disk.
+    """
+    def __init__(self, cache_dir, max_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key, names, mmap_mode='r'):
+        """
+            Args:
+            key (str): entry key from `artifact_key`.
+            names (list): names of the arrays to load.
+            mmap_mode (str or None): passed to `np.load`.
+            Returns:
+            dict or None: arrays stored under `key`, or None on a cache miss.
+        """
+        entry_dir = self._entry_dir(key)
+        filenames = [os.path.join(entry_dir, name + '.npy') for name in names]
+
+        if not all(os.path.exists(filename) for filename in filenames):
+            return None
+
+        # Mark as recently used
+        os.utime(entry_dir, None)
+
+        return {name: np.load(filename, mmap_mode=mmap_mode)
+                    for name, filename in zip(names, filenames)}
+
+    def save(self, key, **arrays):
+        """
+            Store `arrays` under `key` and evict old entries if the cache
+            grew beyond `max_bytes`.
+
+            Args:
+            key (str): entry key from `artifact_key`.
+            arrays (nDarray): arrays to store, by name.
+        """
+        entry_dir = self._entry_dir(key)
+
+        # Write to a temporary directory first so that a partial entry is
+        #   never seen by `load`
+        tmp_dir = '{}.tmp{}'.format(entry_dir, os.getpid())
+        if os.path.exists(tmp_dir): shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), np.asarray(arr))
+
+        # Move an existing entry aside rather than deleting it first, so that
+        #   the key is never left without a complete entry on disk
+        old_dir = '{}.tmp{}.old'.format(entry_dir, os.getpid())
+        if os.path.exists(old_dir): shutil.rmtree(old_dir)
+        try:
+            if os.path.exists(entry_dir): os.rename(entry_dir, old_dir)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process stored (or moved) this key in the meantime;
+            #   keep whichever entry is in place
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(entry_dir) and os.path.exists(old_dir):
+                os.rename(old_dir, entry_dir)
+
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def entries(self):
+        """
+            Returns:
+            list: (last use time, size in bytes, key) of every entry, oldest
+                first.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if '.tmp' in key or not os.path.isdir(entry_dir): continue
+
+            size = sum(os.path.getsize(os.path.join(entry_dir, filename))
+                            for filename in os.listdir(entry_dir))
+
+            entries.append((os.path.getmtime(entry_dir), size, key))
+
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """
+            Remove the least recently used entries until the cache fits in
+            `max_bytes`.
+
+            Args:
+            keep (str or None): key of an entry that is never removed.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, key in entries:
+            if total <= self.max_bytes: break
+            if key == keep: continue
+
+            # Another process may have removed the entry already
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,167 @@
+'''
+Optional compiled kernels for the BLISS and KRDATA hot loops.
+
+`bliss` and `krdata` use their pure numpy implementations by default. If
+`numba` is importable, `set_backend('numba')` compiles the kernels in this
+module and makes `bliss` and `krdata` use them instead. The compiled kernels
+are only cached on disk if asked to (`set_backend('numba', cache=True)`); the
+cache then follows numba's rules, i.e. `NUMBA_CACHE_DIR` if it is set, else
+the `__pycache__` directory of this package (or a user-wide directory if that
+is not writable).
+'''
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+_backend = 'numpy'
+
+# Python versions of the kernels, compiled by `set_backend('numba')`
+_kernel_functions = {}
+
+# Cache setting with which the kernels were last compiled
+_compiled_cache = None
+
+def _kernel(function):
+    _kernel_functions[function.__name__] = function
+    return function
+
+def _compile_kernels(cache):
+    global _compiled_cache
+
+    if _compiled_cache == cache: return
+
+    for name, function in _kernel_functions.items():
+        globals()[name] = numba.njit(cache=cache)(function)
+
+    _compiled_cache = cache
+
+def set_backend(backend, cache=False):
+    """
+        Args:
+        backend (str): 'numba' to use the compiled kernels, 'numpy' for the
+                        pure numpy implementations.
+        cache (bool): write the compiled kernels to numba's on-disk cache
+                        (see `NUMBA_CACHE_DIR`); ignored for 'numpy'.
+    """
+    global _backend
+
+    if backend not in ['numba', 'numpy']:
+        raise ValueError("`backend` must be either 'numba' or 'numpy'")
+
+    if backend == 'numba':
+        if not HAS_NUMBA:
+            raise ImportError('`numba` is required for the compiled kernels;'
+                              ' try `pip install numba`')
+
+        _compile_kernels(cache)
+
+    _backend = backend
+
+def get_backend():
+    return _backend
+
+def use_numba():
+    return _backend == 'numba'
+
+@_kernel
+def knot_sums_and_counts(nearest, fluxes, n_knots):
+    """
+        Sum and number of the fluxes associated with each knot.
+
+        Args:
+        nearest (array): index of the nearest knot to each point.
+        fluxes (array): flux of each point.
+        n_knots (int): number of knots in the grid.
+        Returns:
+        sums (array), counts (array): per-knot sum of fluxes and number of points.
+    """
+    sums = np.zeros(n_knots)
+    counts = np.zeros(n_knots, dtype=np.int64)
+    for kp in range(nearest.size):
+        sums[nearest[kp]] += fluxes[kp]
+        counts[nearest[kp]] += 1
+
+    return sums, counts
+
+@_kernel
+def bilinear_interpolate(knot_fluxes, empty_knots, near_indices, delta_x1,
+                         delta_y1, x_bin_size, y_bin_size, norm_factor):
+    """
+        Compiled version of `bliss.interpolateFlux`, for scalar bin sizes.
+    """
+    n_points = near_indices.shape[0]
+    interpolated_fluxes = np.empty(n_points)
+    for kp in range(n_points):
+        i0 = near_indices[kp, 0]
+        i1 = near_indices[kp, 1]
+        i2 = near_indices[kp, 2]
+        i3 = near_indices[kp, 3]
+
+        # If any knot has no flux, use nearest neighbor interpolation.
+        if empty_knots[i0] or empty_knots[i1] or empty_knots[i2] or empty_knots[i3]:
+            interpolated_fluxes[kp] = knot_fluxes[i0]
+            continue
+
+        dx1 = delta_x1[kp]
+        dy1 = delta_y1[kp]
+        dx2 = x_bin_size - dx1
+        dy2 = y_bin_size - dy1
+
+        interpolated_fluxes[kp] = norm_factor * (dx1 * dy2 * knot_fluxes[i0]
+                                               + dx2 * dy2 * knot_fluxes[i1]
+                                               + dx2 * dy1 * knot_fluxes[i2]
+                                               + dx1 * dy1 * knot_fluxes[i3])
+
+    return interpolated_fluxes
+
+@_kernel
+def gaussian_weights(x0, y0, np0, inds):
+    """
+        Compiled version of `krdata.find_qhull_one_point` over all points.
+
+        Args:
+        x0, y0, np0 (array): positions and noise pixels of each point;
+                            np0 is ignored if it sums to zero.
+        inds (array): (N, n_nbr) indices of the nearest neighbors of each point.
+        Returns:
+        array: (N, n_nbr) normalized gaussian weights.
+    """
+    n_points, n_nbr = inds.shape
+    use_np = np0.sum() != 0.0
+
+    dx = np.empty(n_nbr)
+    dy = np.empty(n_nbr)
+    dnp = np.zeros(n_nbr)
+    weights = np.zeros((n_points, n_nbr))
+    for point in range(n_points):
+        for k in range(n_nbr):
+            dx[k] = x0[inds[point, k]] - x0[point]
+            dy[k] = y0[inds[point, k]] - y0[point]
+            if use_np:
+                dnp[k] = np0[inds[point, k]] - np0[point]
+
+        sigx = dx.std()
+        sigy = dy.std()
+        with_np = use_np and dnp.sum() != 0.0
+        signp = dnp.std() if with_np else 1.0
+
+        total = 0.0
+        for k in range(n_nbr):
+            exponent = -dx[k]**2. / (2.0 * sigx**2.) + -dy[k]**2. / (2. * sigy**2.)
+            if with_np:
+                exponent += -dnp[k]**2. / (2. * signp**2.)
+
+            weights[point, k] = np.exp(exponent)
+            total += weights[point, k]
+
+        if total == 0:
+            weights[point, :] = 0.0
+        else:
+            for k in range(n_nbr):
+                weights[point, k] /= total
+
+    return weights
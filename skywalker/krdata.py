@@ -1,8 +1,13 @@
 from functools         import partial
+from os                import makedirs, path
 from multiprocessing   import Pool, cpu_count
-from numpy             import loadtxt, array, sqrt, median, sum, zeros, int64, transpose, float64, std, exp, isfinite, arange, sin
+from numpy             import loadtxt, array, sqrt, median, sum, zeros, int64, transpose, float64, std, exp, isfinite, arange, sin, asarray, where, ascontiguousarray, ndarray, linspace, memmap, int32, argsort, take_along_axis, cumsum, concatenate
+from scipy.sparse      import csr_matrix
 from scipy.spatial     import cKDTree
 from tqdm              import tqdm
+
+from . import kernels
+
 # Global constants.
 y,x = 0,1
 ppm = 1e6
@@ -29,6 +34,137 @@ def find_qhull_one_point(point, x0, y0, np0, inds, kdtree=None):
         return zeros(len(gw_temp))
     return gw_temp / gw_temp.sum()
 
+def gaussian_weights_batched(xpos, ypos, npix, inds, chunk_size=10000, out=None, start=0, stop=None):
+    '''
+        Vectorized `find_qhull_one_point` over all points at once.
+
+        The (N, n_nbr) neighbour offsets, spreads and exponents are computed
+        with array operations over blocks of `chunk_size` rows, which bounds
+        the size of the temporaries.
+
+        Args:
+            xpos, ypos (ndarray): positions of each point
+            npix (ndarray or None): noise pixels of each point; ignored if None
+                or if it sums to zero
+            inds (ndarray): (N, n_nbr) indices of the nearest neighbours
+            chunk_size (int): number of rows per block
+            out (ndarray or None): (N, n_nbr) array in which to store the weights
+            start, stop (int): range of rows to compute (default: all of them)
+        Returns:
+            ndarray: (N, n_nbr) normalized gaussian weights
+    '''
+    n, k = inds.shape
+    if out is None: out = zeros((n, k))
+    if stop is None: stop = n
+
+    use_np = npix is not None and npix.sum() != 0.0
+
+    for row0 in range(start, stop, chunk_size):
+        rows = slice(row0, min(row0 + chunk_size, stop))
+        ind = inds[rows]
+
+        dx = xpos[ind] - xpos[rows, None]
+        dy = ypos[ind] - ypos[rows, None]
+
+        sigx = std(dx, axis=1)[:, None]
+        sigy = std(dy, axis=1)[:, None]
+
+        exponent = -dx**2./(2.0*sigx**2.) + -dy**2./(2.*sigy**2.)
+
+        if use_np:
+            dnp = npix[ind] - npix[rows, None]
+            with_np = dnp.sum(axis=1) != 0.0
+
+            signp = std(dnp[with_np], axis=1)[:, None]
+            exponent[with_np] += -dnp[with_np]**2./(2.*signp**2.)
+
+        gw_temp = exp(exponent)
+        gw_sum = gw_temp.sum(axis=1)[:, None]
+
+        # Rows with no weight at all stay at zero
+        out[rows] = gw_temp / where(gw_sum == 0, 1.0, gw_sum)
+
+    return out
+
+def _gaussian_weights_block(specs, start, stop):
+    from multiprocessing import shared_memory
+
+    # Attach to the shared arrays for this block only, so that every segment
+    #   is closed again even if the pool is terminated afterwards
+    blocks = []
+    arrays = {}
+    try:
+        for name, (shm_name, shape, dtype) in specs.items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            blocks.append(shm)
+            arrays[name] = ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+        gaussian_weights_batched(arrays['xpos'], arrays['ypos'], arrays.get('npix'),
+                                 arrays['inds'], out=arrays['weights'], start=start, stop=stop)
+    finally:
+        arrays.clear()
+        for shm in blocks: shm.close()
+
+def gaussian_weights_shared(xpos, ypos, npix, inds, nCores=None, blocks_per_core=4):
+    '''
+        Multi-core `gaussian_weights_batched`.
+
+        The positions, noise pixels and `inds` are copied once into
+        `multiprocessing.shared_memory`, together with the output weight
+        matrix. Each worker attaches to them and fills contiguous blocks of
+        rows in place, so only the segment names and the block boundaries
+        are sent to the workers.
+
+        Args:
+            xpos, ypos (ndarray): positions of each point
+            npix (ndarray or None): noise pixels of each point
+            inds (ndarray): (N, n_nbr) indices of the nearest neighbours
+            nCores (int or None): number of worker processes (default: all)
+            blocks_per_core (int): number of row blocks per worker, for load balancing
+        Returns:
+            ndarray: (N, n_nbr) normalized gaussian weights
+    '''
+    from multiprocessing import shared_memory
+
+    if nCores is None: nCores = cpu_count()
+
+    n, k = inds.shape
+    arrays = {'xpos': xpos, 'ypos': ypos, 'inds': inds}
+    if npix is not None: arrays['npix'] = npix
+
+    blocks = []
+    specs = {}
+    weights = None
+    try:
+        for name, arr in arrays.items():
+            arr = ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            blocks.append(shm)
+            ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            specs[name] = (shm.name, arr.shape, arr.dtype.str)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(n * k * 8, 1))
+        blocks.append(shm)
+        weights = ndarray((n, k), dtype=float64, buffer=shm.buf)
+        specs['weights'] = (shm.name, (n, k), weights.dtype.str)
+
+        bounds = linspace(0, n, nCores * blocks_per_core + 1).astype(int64)
+
+        # The pool is terminated on exit, including when a worker raises
+        with Pool(nCores) as pool:
+            pool.starmap(_gaussian_weights_block,
+                         [(specs, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])])
+
+        gw = weights.copy()
+    finally:
+        # Release the view before closing its buffer
+        weights = None
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return gw
+
 def gaussian_weights_and_nearest_neighbors(xpos, ypos, npix = None, inds = None, n_nbr = 50, returnInds=False, a = 1.0, b = 0.7, c = 1.0, expansion = 1000., nCores=1):
     '''
         Python Implimentation of N. Lewis method, described in Lewis etal 2012, Knutson etal 2012, Fraine etal 2013
@@ -48,22 +184,167 @@ def gaussian_weights_and_nearest_neighbors(xpos, ypos, npix = None, inds = None,
     '''
     n, k   = inds.shape                           # This is the number of nearest neighbors you want
 
-    func  = partial(find_qhull_one_point, x0=xpos, y0=ypos, np0=npix, inds=inds)
-
     if nCores > 1:
-        raise Exception('Check to make sure that Multiprocessing is working correctly -- examine the Activity Monitor.')
-        pool  = Pool(nCores)
-
-        gw_list = pool.starmap(func, zip(range(n)))
-
-        pool.close()
-        pool.join()
+        gw_list = gaussian_weights_shared(xpos, ypos, npix, inds, nCores=nCores)
+    elif kernels.use_numba():
+        np0 = npix if npix is not None else zeros(n)
+        gw_list = kernels.gaussian_weights(asarray(xpos, dtype=float64), asarray(ypos, dtype=float64),
+                                           asarray(np0, dtype=float64), inds)
     else:
-        gw_list = []
-        for idx in range(n):
-            gw_list.append(func(idx))
+        gw_list = gaussian_weights_batched(xpos, ypos, npix, inds)
 
     if returnInds:
         return array(gw_list), inds
     else:
         return array(gw_list)
+
+def kernel_regression_operator(inds, weights):
+    '''
+        Store the KRDATA neighbours and weights as a single sparse matrix.
+
+        Row i of the (N, N) matrix holds the gaussian weights of the nearest
+        neighbours of point i, so the sensitivity map
+
+            sum(residuals[inds] * weights, axis=1)
+
+        becomes the single mat-vec `operator.dot(residuals)`, without the two
+        (N, n_nbr) temporaries.
+
+        Args:
+            inds (ndarray): (N, n_nbr) indices of the nearest neighbours
+            weights (ndarray): (N, n_nbr) gaussian weights of those neighbours
+        Returns:
+            csr_matrix: (N, N) kernel regression operator
+    '''
+    n, k = inds.shape
+    return csr_matrix((weights.ravel(), inds.ravel(), arange(0, n*k + 1, k)), shape=(n, n))
+
+def adaptive_kernel_regression_operator(inds, weights, weight_tol=1e-3):
+    '''
+        `kernel_regression_operator` with a per-point number of neighbours.
+
+        The neighbours of each point are ranked by weight and truncated once
+        their cumulative normalized weight reaches 1 - `weight_tol`; the kept
+        weights are renormalized to sum to one. Rows therefore have different
+        lengths, which the CSR layout stores without padding.
+
+        Args:
+            inds (ndarray): (N, n_nbr) indices of the nearest neighbours
+            weights (ndarray): (N, n_nbr) gaussian weights of those neighbours
+            weight_tol (float): fraction of the total weight that may be dropped
+        Returns:
+            csr_matrix: (N, N) kernel regression operator
+    '''
+    n, k = inds.shape
+
+    order = argsort(-weights, axis=1)
+    sorted_weights = take_along_axis(weights, order, axis=1)
+    sorted_inds = take_along_axis(inds, order, axis=1)
+
+    # Number of heaviest neighbours needed to reach 1 - weight_tol
+    n_keep = (cumsum(sorted_weights, axis=1) < 1.0 - weight_tol).sum(axis=1) + 1
+    n_keep[n_keep > k] = k
+
+    keep = arange(k)[None, :] < n_keep[:, None]
+    data = sorted_weights[keep]
+    indptr = concatenate([[0], cumsum(n_keep)])
+
+    row_sums = sum(sorted_weights * keep, axis=1)
+    data /= where(row_sums == 0, 1.0, row_sums).repeat(n_keep)
+
+    return csr_matrix((data, sorted_inds[keep], indptr), shape=(n, n))
+
+def query_nearest_neighbors(kdtree, points, n_nbr, workers=-1):
+    '''
+        Indices of the `n_nbr` nearest neighbours of each of `points` in
+        `kdtree`, excluding the point itself.
+
+        Args:
+            kdtree (cKDTree): tree built over the (expanded) points
+            points (ndarray): (N, 3) points to query; rows of `kdtree.data`
+            n_nbr (int): number of neighbours per point
+            workers (int): number of query threads (-1 uses all of them)
+        Returns:
+            ndarray: (N, n_nbr) int32 neighbour indices
+    '''
+    try:
+        inds = kdtree.query(points, n_nbr+1, workers=workers)[1]
+    except TypeError:
+        # scipy < 1.6
+        inds = kdtree.query(points, n_nbr+1, n_jobs=workers)[1]
+
+    # Drop the point itself; int32 halves the memory of the indices
+    return inds[:,1:].astype(int32)
+
+class MemmapKernelRegression(object):
+    '''
+        Out-of-core KRDATA neighbours and weights.
+
+        The (N, n_nbr) neighbour indices and gaussian weights are stored in
+        memory-mapped files under `memmap_dir` and are both filled and used
+        in blocks of `block_size` rows, so the working set stays at
+        O(block_size * n_nbr) whatever the number of points. `dot` computes
+        the sensitivity map the same way as `kernel_regression_operator`,
+        so instances can be passed as `gw_kdtree` with `ind_kdtree` = None.
+
+        Args:
+            memmap_dir (str): directory holding `inds.dat` and `weights.dat`
+            n_points (int): number of points N
+            n_nbr (int): number of neighbours per point
+            block_size (int): number of rows per block
+            mode (str): `numpy.memmap` mode; 'w+' creates new files, 'r'
+                reopens the files of a previous run
+    '''
+    def __init__(self, memmap_dir, n_points, n_nbr, block_size=100000, mode='w+'):
+        if not path.exists(memmap_dir): makedirs(memmap_dir)
+
+        self.memmap_dir = memmap_dir
+        self.block_size = block_size
+        self.shape = (n_points, n_points)
+
+        self.inds = memmap(path.join(memmap_dir, 'inds.dat'), dtype=int32,
+                           mode=mode, shape=(n_points, n_nbr))
+        self.weights = memmap(path.join(memmap_dir, 'weights.dat'), dtype=float64,
+                              mode=mode, shape=(n_points, n_nbr))
+
+    def _blocks(self):
+        n = self.shape[0]
+        for row0 in range(0, n, self.block_size):
+            yield slice(row0, min(row0 + self.block_size, n))
+
+    def fill(self, kdtree, xpos, ypos, npix=None, workers=-1):
+        '''
+            Query the neighbours and compute their gaussian weights, one
+            block at a time.
+
+            Args:
+                kdtree (cKDTree): tree built over the (expanded) points
+                xpos, ypos (ndarray): positions of each point
+                npix (ndarray or None): noise pixels of each point
+                workers (int): number of KDTree query threads
+        '''
+        n_nbr = self.inds.shape[1]
+        for rows in self._blocks():
+            self.inds[rows] = query_nearest_neighbors(kdtree, kdtree.data[rows],
+                                                      n_nbr, workers=workers)
+            gaussian_weights_batched(xpos, ypos, npix, self.inds, out=self.weights,
+                                     chunk_size=self.block_size,
+                                     start=rows.start, stop=rows.stop)
+
+        self.inds.flush()
+        self.weights.flush()
+
+        return self
+
+    def dot(self, residuals):
+        '''
+            Args:
+                residuals (ndarray): (N,) residuals of each point
+            Returns:
+                ndarray: (N,) sensitivity map
+        '''
+        sensitivity_map = zeros(self.shape[0])
+        for rows in self._blocks():
+            sensitivity_map[rows] = sum(residuals[self.inds[rows]] * self.weights[rows], axis=1)
+
+        return sensitivity_map
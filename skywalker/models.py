@@ -1,9 +1,12 @@
 import batman
 import numpy as np
+from batman import _quadratic_ld # used by `transit_model_batch`
 from . import bliss
 from . import utils
 from . import krdata as kr
+from . import pld
 
+from collections import OrderedDict
 from functools import partial
 from statsmodels.robust import scale
 from sklearn.decomposition import PCA, FastICA
@@ -17,48 +20,217 @@ ppm = 1e6
 day_to_seconds = 86400
 zero = 0.0
 
-def transit_model_func(model_params, times, init_t0=0.0, ldtype='quadratic', transitType='primary'):
+# Initialized batman.TransitModel objects, keyed on (id(times), transitType, ldtype);
+#   each entry also holds `times` itself, so that the id cannot be reused
+_transit_model_cache = OrderedDict()
+transit_model_cache_size = 16
+
+def clear_transit_model_cache():
+    _transit_model_cache.clear()
+
+def cached_transit_model(bm_params, times, transitType='primary'):
     """
         Args:
-            model_params: Parameters() object with orbital properties for a given exoplanet.
-            times: array of dates in units of days utilized for the photometry time series.
-            init_t0: transit center time.
-            ldtype: transit model type.
+            bm_params: batman.TransitParams() object.
+            times: array of dates; the cache holds a reference to it.
             transitType: 'primary' for transit, 'secondary' for eclipse.
         Returns:
-            The Dark Knight phase curve model.
+            batman.TransitModel initialized on `times`, reused across calls with
+            the same `times` array, `transitType` and limb darkening law.
+            
+            For eclipses, `bm_params.t0` is set to the time of conjunction derived 
+            from `t_secondary`, as batman does when the model is initialized: a 
+            reused model compares it with the converted t0 of the previous call.
     """
-    # Transit Parameters
-    u1 = model_params['u1'].value
-    u2 = model_params['u2'].value
+    key = (id(times), transitType, bm_params.limb_dark)
+    
+    if key in _transit_model_cache and _transit_model_cache[key][0] is times:
+        _transit_model_cache.move_to_end(key)
+        m_eclipse = _transit_model_cache[key][1]
+        
+        if transitType == 'secondary': bm_params.t0 = m_eclipse.get_t_conjunction(bm_params)
+        
+        # The step size factor of the numerically integrated limb darkening laws
+        #   depends on rp and u; batman only recomputes it when the law changes
+        if bm_params.limb_dark not in ['uniform', 'linear', 'quadratic'] \
+            and (abs(bm_params.rp) != m_eclipse.rp or list(bm_params.u) != list(m_eclipse.u)):
+            m_eclipse.rp = abs(bm_params.rp)
+            m_eclipse.u = bm_params.u
+            m_eclipse.fac = m_eclipse._get_fac()
+        
+        return m_eclipse
+    
+    m_eclipse = batman.TransitModel(bm_params, times, transittype=transitType)
+    
+    _transit_model_cache[key] = (times, m_eclipse)
+    while len(_transit_model_cache) > transit_model_cache_size: _transit_model_cache.popitem(last=False)
+    
+    return m_eclipse
 
-    bm_params = batman.TransitParams() # object to store transit parameters
+# Times inside the event windows of `transit_model_func`, keyed on (id(times), windows)
+_window_times_cache = OrderedDict()
+
+def window_times(times, windows):
+    """
+        Args:
+            times: array of dates.
+            windows: list of (start, stop) index ranges; see `event_windows`.
+        Returns:
+            indices and times inside `windows`; the same arrays are returned for
+            the same `times` and `windows`, so that `cached_transit_model` hits.
+    """
+    key = (id(times), tuple(windows))
+    
+    if key in _window_times_cache and _window_times_cache[key][0] is times:
+        _window_times_cache.move_to_end(key)
+        return _window_times_cache[key][1:]
+    
+    idx = np.concatenate([np.arange(start, stop) for start, stop in windows])
+    
+    _window_times_cache[key] = (times, idx, times[idx])
+    while len(_window_times_cache) > transit_model_cache_size: _window_times_cache.popitem(last=False)
+    
+    return idx, _window_times_cache[key][2]
+
+def event_windows(times, period, t_event, aprs, rprs, inc, margin=0.1, block_size=256):
+    """
+        Index ranges of `times` around every event (transit or eclipse) at
+        t_event + n * period in the data span, for circular orbits.
+        
+        Args:
+            times: sorted array of dates.
+            period: orbital period.
+            t_event: time of one transit or eclipse center.
+            aprs: semi-major axis in units of stellar radii.
+            rprs: planet radius in units of stellar radii.
+            inc: inclination in degrees.
+            margin: fractional safety margin added to the event duration.
+            block_size: the ranges are widened to multiples of `block_size` so
+                        that they only change when an event moves by a block.
+        Returns:
+            list of (start, stop) index ranges, [] if the planet never
+            transits, or None if the duration cannot be computed.
+    """
+    if inc2b(inc, aprs) >= 1.0 + rprs: return []
+    
+    half_width = 0.5 * (1.0 + margin) * transit_duration(period, aprs, rprs, inc)
+    if not np.isfinite(half_width): return None
+    
+    n_first = np.floor((times[0] - half_width - t_event) / period)
+    n_last = np.ceil((times[-1] + half_width - t_event) / period)
+    centers = t_event + period * np.arange(n_first, n_last + 1)
+    
+    starts = np.searchsorted(times, centers - half_width, side='left')
+    stops = np.searchsorted(times, centers + half_width, side='right')
+    
+    starts = (starts // block_size) * block_size
+    stops = np.minimum(-(-stops // block_size) * block_size, times.size)
     
-    if 'deltaTc' in model_params.keys():
-        if 'deltaEc' in model_params.keys():
-            bm_params.t_secondary = model_params['deltaTc'] + init_t0 + 0.5*model_params['period'] + model_params['deltaEc']
+    windows = []
+    for start, stop in zip(starts, stops):
+        if stop <= start: continue
+        if windows and start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(stop, windows[-1][1]))
         else:
-            bm_params.t_secondary = model_params['deltaTc'] + init_t0 + 0.5*model_params['period']
-    else:
-        bm_params.t_secondary = init_t0 + 0.5*model_params['period']
+            windows.append((start, stop))
     
-    if 'edepth' not in model_params.keys(): model_params.add('edepth', 0.0, False)
+    return windows
+
+def secondary_eclipse_time(values, init_t0=0.0):
+    """
+        Args:
+            values: dict of parameter name to value, or Parameters() object.
+            init_t0: transit center time.
+        Returns:
+            time of the secondary eclipse, as used by batman.
+    """
+    if 'deltaTc' in values.keys():
+        if 'deltaEc' in values.keys():
+            return values['deltaTc'] + init_t0 + 0.5*values['period'] + values['deltaEc']
+        else:
+            return values['deltaTc'] + init_t0 + 0.5*values['period']
+    else:
+        return init_t0 + 0.5*values['period']
+
+def batman_params(values, init_t0=0.0, ldtype='quadratic'):
+    """
+        Args:
+            values: dict of parameter name to value (e.g. from a Parameters() object).
+            init_t0: transit center time.
+            ldtype: limb darkening model.
+        Returns:
+            batman.TransitParams() object for these values.
+    """
+    bm_params = batman.TransitParams() # object to store transit parameters
     
-    rprs = np.sqrt(model_params['tdepth'].value)
-    bm_params.per = model_params['period'].value            # orbital period
-    bm_params.t0 = model_params['deltaTc'].value + init_t0  # time of inferior conjunction
-    bm_params.inc = model_params['inc'].value               # inclunaition in degrees
-    bm_params.a = model_params['aprs'].value                # semi-major axis (in units of stellar radii)
-    bm_params.rp = rprs                                     # planet radius (in units of stellar radii)
-    bm_params.fp = model_params['edepth'].value             # planet radius (in units of stellar radii)
-    bm_params.ecc = model_params['ecc'].value               # eccentricity
-    bm_params.w = model_params['omega'].value               # longitude of periastron (in degrees)
+    bm_params.t_secondary = secondary_eclipse_time(values, init_t0)
+    bm_params.per = values['period']                        # orbital period
+    bm_params.t0 = values['deltaTc'] + init_t0              # time of inferior conjunction
+    bm_params.inc = values['inc']                           # inclunaition in degrees
+    bm_params.a = values['aprs']                            # semi-major axis (in units of stellar radii)
+    bm_params.rp = np.sqrt(values['tdepth'])                # planet radius (in units of stellar radii)
+    bm_params.fp = values.get('edepth', 0.0)                # planet radius (in units of stellar radii)
+    bm_params.ecc = values['ecc']                           # eccentricity
+    bm_params.w = values['omega']                           # longitude of periastron (in degrees)
     bm_params.limb_dark = ldtype                            # limb darkening model # NEED TO FIX THIS
-    bm_params.u = [u1, u2]                                  # limb darkening coefficients # NEED TO FIX THIS
+    bm_params.u = [values['u1'], values['u2']]              # limb darkening coefficients # NEED TO FIX THIS
     
-    m_eclipse = batman.TransitModel(bm_params, times, transittype=transitType) # initializes model
+    return bm_params
+
+def batman_light_curve(bm_params, times, transitType='primary', use_cache=True, use_windows=True):
+    """
+        Args:
+            bm_params: batman.TransitParams() object; see `batman_params`.
+            times: array of dates in units of days utilized for the photometry time series.
+            transitType: 'primary' for transit, 'secondary' for eclipse.
+            use_cache, use_windows: see `transit_model_func`.
+        Returns:
+            batman light curve on `times`.
+    """
+    windows = None
+    if use_windows and bm_params.ecc == 0 and np.all(times[1:] >= times[:-1]):
+        t_event = bm_params.t0 if transitType == 'primary' else bm_params.t_secondary
+        windows = event_windows(times, bm_params.per, t_event, bm_params.a, bm_params.rp, bm_params.inc)
+    
+    if windows is not None:
+        # Outside of the events batman returns exactly 1 (transit) or 1 + fp (eclipse)
+        light_curve = np.ones(times.size) if transitType == 'primary' else np.ones(times.size) + bm_params.fp
+        if len(windows) == 0: return light_curve
+        
+        idx, times = window_times(times, windows)
+    
+    if use_cache:
+        m_eclipse = cached_transit_model(bm_params, times, transitType=transitType)
+    else:
+        m_eclipse = batman.TransitModel(bm_params, times, transittype=transitType) # initializes model
     
-    return m_eclipse.light_curve(bm_params)# + oot_offset
+    if windows is None: return m_eclipse.light_curve(bm_params)# + oot_offset
+    
+    light_curve[idx] = m_eclipse.light_curve(bm_params)
+    
+    return light_curve
+
+def transit_model_func(model_params, times, init_t0=0.0, ldtype='quadratic', transitType='primary', use_cache=True, use_windows=True):
+    """
+        Args:
+            model_params: Parameters() object with orbital properties for a given exoplanet.
+            times: array of dates in units of days utilized for the photometry time series.
+            init_t0: transit center time.
+            ldtype: transit model type.
+            transitType: 'primary' for transit, 'secondary' for eclipse.
+            use_cache: reuse the batman.TransitModel initialized on `times`; see `cached_transit_model`.
+            use_windows: only evaluate batman inside the transit or eclipse windows (see `event_windows`)
+                        and fill in 1 (transit) or 1 + edepth (eclipse) elsewhere; circular orbits and
+                        sorted times only, otherwise the full light curve is computed.
+        Returns:
+            The Dark Knight phase curve model.
+    """
+    if 'edepth' not in model_params.keys(): model_params.add('edepth', 0.0, False)
+    
+    values = {name: param.value for name, param in model_params.items()}
+    bm_params = batman_params(values, init_t0=init_t0, ldtype=ldtype)
+    
+    return batman_light_curve(bm_params, times, transitType=transitType, use_cache=use_cache, use_windows=use_windows)
 
 eclipse_model_func = partial(transit_model_func, transitType='secondary')
 
@@ -102,6 +274,79 @@ def line_model_func(model_params, times):
     
     return line_model
 
+# cos and sin of 2 pi (times - times[0]) / period, keyed on (id(times), period)
+_phase_basis_cache = OrderedDict()
+
+def phase_basis(times, period, t_secondary):
+    """
+        Args:
+            times: array of dates; the cache holds a reference to it.
+            period: orbital period.
+            t_secondary: time of secondary eclipse.
+        Returns:
+            cos and sin of 2 pi (times - t_secondary) / period. The cos and sin
+            of the phase from `times[0]` are cached while `times` and `period`
+            do not change, and rotated by the phase of `t_secondary` with the
+            angle-difference identities; so only a change of `period` costs
+            new cos and sin evaluations.
+    """
+    key = (id(times), float(period))
+    
+    if key in _phase_basis_cache and _phase_basis_cache[key][0] is times:
+        _phase_basis_cache.move_to_end(key)
+    else:
+        phase = 2*np.pi / period * (times - times.flat[0])
+        
+        _phase_basis_cache[key] = (times, np.cos(phase), np.sin(phase))
+        while len(_phase_basis_cache) > transit_model_cache_size: _phase_basis_cache.popitem(last=False)
+    
+    _, cos_ref, sin_ref = _phase_basis_cache[key]
+    
+    offset = 2*np.pi / period * (t_secondary - times.flat[0])
+    cos_offset, sin_offset = np.cos(offset), np.sin(offset)
+    
+    return cos_ref*cos_offset + sin_ref*sin_offset, sin_ref*cos_offset - cos_ref*sin_offset
+
+def n_harmonics(names):
+    """
+        Returns:
+            highest k of the `cosAmp{k}` / `sinAmp{k}` names in `names` (0 if none).
+    """
+    orders = [int(name[6:]) for name in names if name[:6] in ['cosAmp', 'sinAmp'] and name[6:].isdigit()]
+    
+    return max(orders) if len(orders) else 0
+
+def harmonic_phase_curve(cos_phase, sin_phase, cos_amps, sin_amps):
+    """
+        sum_k cos_amps[k-1] cos(k phase) + sin_amps[k-1] sin(k phase), with the
+        harmonics built by the Chebyshev recurrence
+        
+            cos((k+1) phase) = 2 cos(phase) cos(k phase) - cos((k-1) phase)
+            sin((k+1) phase) = 2 cos(phase) sin(k phase) - sin((k-1) phase)
+        
+        so that each harmonic only costs multiply-adds.
+        
+        Args:
+            cos_phase, sin_phase: cos and sin of the phase; see `phase_basis`.
+            cos_amps, sin_amps: amplitudes of harmonics 1 to N; scalars, or (n_sets, 1)
+                        columns for many parameter sets.
+        Returns:
+            phase curve (without offset).
+    """
+    two_cos = 2.0 * cos_phase
+    cos_prev, sin_prev = 1.0, 0.0
+    cos_k, sin_k = cos_phase, sin_phase
+    
+    phase_curve = 0.0
+    for k, (cos_amp, sin_amp) in enumerate(zip(cos_amps, sin_amps)):
+        phase_curve = phase_curve + cos_amp*cos_k + sin_amp*sin_k
+        
+        if k + 1 < len(cos_amps):
+            cos_prev, cos_k = cos_k, two_cos*cos_k - cos_prev
+            sin_prev, sin_k = sin_k, two_cos*sin_k - sin_prev
+    
+    return phase_curve
+
 def phase_curve_func(model_params, times, init_t0):
     
     if 'period' not in model_params.keys(): raise Exception('`period` not included in `model_params`')
@@ -112,18 +357,23 @@ def phase_curve_func(model_params, times, init_t0):
         t_secondary = init_t0 + 0.5*model_params['period']
     
     ang_freq = 2*np.pi / model_params['period']
+    # cosAmp/cosPhase takes precedence over cosAmp/sinAmp, which takes precedence over the
+    #   numbered harmonics (cosAmp1, sinAmp1, ...); the same order as `phase_curve_batch`
+    n_harm = n_harmonics(model_params.keys())
     if 'cosPhase' in model_params.keys() and 'cosAmp' in model_params.keys():
         half = 0.5 # necessary because the "amplitude" of a cosine is HALF the "amplitude"" of the phase curve
         # phase_curve = half*model_params['cosAmp']*np.cos(ang_freq * (times - t_secondary) + model_params['cosPhase'])
         phase_curve = half*model_params['cosAmp']*np.cos(ang_freq * (times - t_secondary + model_params['cosPhase']))
     elif 'sinAmp' in model_params.keys() and 'cosAmp' in model_params.keys():
-        phase_curve = model_params['cosAmp']*np.cos(ang_freq * (times - t_secondary)) + model_params['sinAmp']*np.sin(ang_freq * (times - t_secondary))
-    elif 'sinAmp1' in model_params.keys() and 'cosAmp1' in model_params.keys():
-        if 'sinAmp2' in model_params.keys() and 'cosAmp2' in model_params.keys():
-            phase_curve = model_params['cosAmp1']*np.cos(ang_freq * (times - t_secondary)) + model_params['sinAmp1']*np.sin(ang_freq * (times - t_secondary)) + \
-                           model_params['cosAmp2']*np.cos(2*ang_freq * (times - t_secondary)) + model_params['sinAmp2']*np.sin(2*ang_freq * (times - t_secondary))
-        else:
-            phase_curve = model_params['cosAmp1']*np.cos(ang_freq * (times - t_secondary)) + model_params['sinAmp1']*np.sin(ang_freq * (times - t_secondary))
+        cos_phase, sin_phase = phase_basis(times, model_params['period'].value, t_secondary)
+        phase_curve = model_params['cosAmp'].value*cos_phase + model_params['sinAmp'].value*sin_phase
+    elif n_harm > 0:
+        # cosAmp1, sinAmp1, cosAmp2, sinAmp2, ...; missing amplitudes are zero
+        cos_amps = [model_params['cosAmp{}'.format(k)].value if 'cosAmp{}'.format(k) in model_params.keys() else 0.0 for k in range(1, n_harm+1)]
+        sin_amps = [model_params['sinAmp{}'.format(k)].value if 'sinAmp{}'.format(k) in model_params.keys() else 0.0 for k in range(1, n_harm+1)]
+        
+        cos_phase, sin_phase = phase_basis(times, model_params['period'].value, t_secondary)
+        phase_curve = harmonic_phase_curve(cos_phase, sin_phase, cos_amps, sin_amps)
     else:
         phase_curve = np.array(0)
     
@@ -134,13 +384,11 @@ def phase_curve_func(model_params, times, init_t0):
     return phase_curve + 1.0 - phase_curve.min() + abs(model_params['night_flux'].value)
 
 def inc2b(inc, aRs, e = 0, w = 0):
-    #convert_inc_to_b
-    if e == 0:
-        return aRs * cos(inc)
-    elif w == 0:
-        return aRs * cos(inc) * (1 - e*e)
-    else:
-        return aRs * cos(inc) * (1 - e*e) / (1.0 - e*sin(w))
+    #convert_inc_to_b; `inc` and `w` in degrees, as in batman
+    inc = np.radians(inc)
+    w = np.radians(w)
+    
+    return aRs * np.cos(inc) * (1 - e*e) / (1.0 + e*np.sin(w))
 
 def transit_duration(period, aprs, rprs, inc):
     ''' Compute the transit duration from tangent (t1) to tangent (t4)
@@ -150,7 +398,7 @@ def transit_duration(period, aprs, rprs, inc):
     b_imp = inc2b(inc, aprs)
     
     out_sin = period/np.pi
-    in_sin = np.sqrt((1+rprs)**2 - b_imp) / aprs / np.sin(inc)
+    in_sin = np.sqrt((1+rprs)**2 - b_imp**2) / aprs / np.sin(np.radians(inc))
     
     return out_sin * np.arcsin(in_sin)
 
@@ -162,98 +410,364 @@ def transit_full(period, aprs, rprs, inc):
     b_imp = inc2b(inc, aprs)
     
     out_sin = period/np.pi
-    in_sin = np.sqrt((1-rprs)**2 - b_imp) / aprs / np.sin(inc)
+    in_sin = np.sqrt((1-rprs)**2 - b_imp**2) / aprs / np.sin(np.radians(inc))
     
     return out_sin * np.arcsin(in_sin)
 
+def contact_points(period, t_event, aprs, rprs, inc, t_start, t_end):
+    """
+        Contact times of every transit or eclipse between `t_start` and `t_end`,
+        for circular orbits.
+        
+        Args:
+            period: orbital period.
+            t_event: time of one transit or eclipse center.
+            aprs: semi-major axis in units of stellar radii.
+            rprs: planet radius in units of stellar radii.
+            inc: inclination in degrees.
+            t_start, t_end: data span.
+        Returns:
+            (n_events, 4) array of the t1, t2, t3, t4 contact times; t2 = t3 for
+            grazing events and n_events = 0 if the planet never transits.
+    """
+    with np.errstate(invalid='ignore'):
+        t14 = transit_duration(period, aprs, rprs, inc)
+        t23 = transit_full(period, aprs, rprs, inc)
+    
+    if not np.isfinite(t14): return np.zeros((0, 4))
+    if not np.isfinite(t23): t23 = 0.0
+    
+    n_first = np.floor((t_start - 0.5*t14 - t_event) / period)
+    n_last = np.ceil((t_end + 0.5*t14 - t_event) / period)
+    centers = t_event + period * np.arange(n_first, n_last + 1)
+    
+    return np.transpose([centers - 0.5*t14, centers - 0.5*t23, 
+                         centers + 0.5*t23, centers + 0.5*t14])
+
+def eclipse_contact_points(model_params, times, init_t0):
+    """
+        `contact_points` of the eclipses described by `model_params` over `times`.
+    """
+    t_secondary = float(secondary_eclipse_time(model_params, init_t0))
+    
+    return contact_points(model_params['period'].value, t_secondary, model_params['aprs'].value, 
+                          np.sqrt(model_params['tdepth'].value), model_params['inc'].value, 
+                          times.min(), times.max())
+
+def trapezoid_occultation(times, contacts):
+    """
+        Args:
+            times: array of dates.
+            contacts: (n_events, 4) contact times; see `contact_points`.
+        Returns:
+            trapezoid that is 0 out of the events, 1 between t2 and t3, and linear
+            during ingress and egress.
+    """
+    if len(contacts) == 0: return np.zeros(times.size)
+    
+    return np.interp(times, contacts.ravel(), np.tile([0.0, 1.0, 1.0, 0.0], len(contacts)), left=0.0, right=0.0)
+
 def trapezoid_model(model_params, times, init_t0, 
                     delta_eclipse_time=0.0, eclipse_model=None):
+    """
+        Trapezoid eclipse model, 1 + edepth out of eclipse and 1 at the bottom, 
+        built from the analytic contact points of every eclipse in `times`.
+        
+        Args:
+            model_params: Parameters() object with orbital properties.
+            times: array of dates.
+            init_t0: transit center time.
+            delta_eclipse_time: shift of the eclipses.
+            eclipse_model: unused; kept for backwards compatibility.
+        Returns:
+            trapezoid eclipse model.
+    """
+    contacts = eclipse_contact_points(model_params, times, init_t0) + delta_eclipse_time
+    
+    return 1.0 + model_params['edepth'].value * (1.0 - trapezoid_occultation(times, contacts))
+
+def batch_parameter_values(theta, param_names, model_params):
+    """
+        Args:
+            theta: (n_sets, n_params) array of parameter sets.
+            param_names: names of the n_params columns of `theta`.
+            model_params: Parameters() object; the values of the parameters not in
+                        `param_names` are held fixed across the sets.
+        Returns:
+            dict of parameter name to (n_sets,) array of values.
+    """
+    theta = np.atleast_2d(theta)
+    
+    values = {name: np.full(theta.shape[0], param.value) for name, param in model_params.items()}
+    for k, name in enumerate(param_names): values[name] = theta[:, k]
+    
+    return values
+
+def _batch_column(values, name, default=0.0):
+    return np.reshape(values.get(name, default), (-1, 1))
+
+def line_model_batch(values, times):
+    """
+        `line_model_func` for many parameter sets; see `batch_parameter_values`.
+    """
+    times_shift = times - times.mean()
+    
+    return _batch_column(values, 'intercept', 1.0) \
+            + _batch_column(values, 'slope') * times_shift \
+            + _batch_column(values, 'curvature') * times_shift**2
+
+def phase_curve_batch(values, times, init_t0):
+    """
+        `phase_curve_func` for many parameter sets; see `batch_parameter_values`.
+    """
+    period = _batch_column(values, 'period')
+    
+    if 'deltaTc' in values.keys() and 'deltaEc' in values.keys():
+        t_secondary = init_t0 + _batch_column(values, 'deltaTc') + 0.5*period + _batch_column(values, 'deltaEc')
+    else:
+        t_secondary = init_t0 + 0.5*period
+    
+    ang_freq = 2*np.pi / period
+    phase = ang_freq * (times - t_secondary)
+    
+    col = partial(_batch_column, values)
+    n_harm = n_harmonics(values.keys())
+    if 'cosPhase' in values.keys() and 'cosAmp' in values.keys():
+        phase_curve = 0.5*col('cosAmp')*np.cos(phase + ang_freq * col('cosPhase'))
+    elif 'sinAmp' in values.keys() and 'cosAmp' in values.keys():
+        phase_curve = col('cosAmp')*np.cos(phase) + col('sinAmp')*np.sin(phase)
+    elif n_harm > 0:
+        phase_curve = harmonic_phase_curve(np.cos(phase), np.sin(phase), 
+                                           [col('cosAmp{}'.format(k)) for k in range(1, n_harm+1)], 
+                                           [col('sinAmp{}'.format(k)) for k in range(1, n_harm+1)])
+    else:
+        phase_curve = np.zeros((period.shape[0], 1))
+    
+    return phase_curve + 1.0 - phase_curve.min(axis=1)[:, None] + abs(col('night_flux'))
+
+def nearest_eclipse_batch(values, times, init_t0):
+    """
+        Center of the eclipse nearest to each of `times` and the analytic (circular
+        orbit) eclipse durations, for many parameter sets; see `batch_parameter_values`.
+        
+        Returns:
+            centers: (n_sets, n_times) time of the nearest eclipse center.
+            t14, t23: (n_sets, 1) total and full eclipse durations; 0 if there is no
+                        eclipse or no full occultation.
+    """
+    col = partial(_batch_column, values)
+    period = col('period')
+    rprs = np.sqrt(col('tdepth'))
+    
+    t_secondary = np.reshape(secondary_eclipse_time(values, init_t0), (-1, 1))
     
-    if eclipse_model is None: 
-        del delta_eclipse_time
-        delta_eclipse_time = 0.0 # reset to avoid later double dipping on the shift in eclipse location
-        eclipse_model = eclipse_model_func(model_params, times, init_t0)
+    with np.errstate(invalid='ignore'):
+        t14 = transit_duration(period, col('aprs'), rprs, col('inc'))
+        t23 = transit_full(period, col('aprs'), rprs, col('inc'))
     
-    ecl_bottom = eclipse_model < eclipse_model.min() + ftol
-    in_eclipse = eclipse_model < eclipse_model.max()
+    # No eclipse at all, or a grazing one without full occultation
+    t14 = np.where(np.isfinite(t14), t14, 0.0)
+    t23 = np.where(np.isfinite(t23), t23, 0.0)
     
-    eclipse0 = in_eclipse * (times < times.mean())
-    eclipse1 = in_eclipse * (times > times.mean())
+    centers = times - ((times - t_secondary + 0.5*period) % period - 0.5*period)
     
-    t1_0 = np.where(eclipse0)[0][0]
-    t2_0 = np.where(eclipse0*ecl_bottom)[0][0]
-    t3_0 = np.where(eclipse0*ecl_bottom)[0][-1]
-    t4_0 = np.where(eclipse0)[0][-1]
+    return centers, t14, t23
+
+def eclipse_occultation_batch(values, times, init_t0, nearest_eclipse=None):
+    """
+        Fraction of the planet hidden by the star, as a trapezoid with the analytic
+        (circular orbit) contact points of every eclipse, for many parameter sets;
+        see `batch_parameter_values` and `trapezoid_occultation`.
+        
+        Args:
+            nearest_eclipse: output of `nearest_eclipse_batch`, if already computed.
+    """
+    if nearest_eclipse is None: nearest_eclipse = nearest_eclipse_batch(values, times, init_t0)
+    centers, t14, t23 = nearest_eclipse
     
-    t1_1 = np.where(eclipse1)[0][0]
-    t2_1 = np.where(eclipse1*ecl_bottom)[0][0]
-    t3_1 = np.where(eclipse1*ecl_bottom)[0][-1]
-    t4_1 = np.where(eclipse1)[0][-1]
+    dt = abs(times - centers)
+    ingress = 0.5*(t14 - t23)
     
-    trap_model = np.ones(times.size) + model_params['edepth'].value
+    return np.clip((0.5*t14 - dt) / np.where(ingress > 0, ingress, np.inf), 0.0, 1.0) \
+            + (dt < 0.5*t23) * (ingress <= 0)
+
+def transit_model_batch(values, times, init_t0=0.0, ldtype='quadratic', transitType='primary'):
+    """
+        `transit_model_func` for many parameter sets; see `batch_parameter_values`.
+        
+        For transits on circular orbits with quadratic limb darkening, the sky
+        separation of every set is computed in one array operation and batman's
+        quadratic routine is called once per distinct (rp, u1, u2), on the points
+        in transit only. Eclipses, eccentric orbits and other laws use one
+        `batman_light_curve` call per set.
+    """
+    n_sets = len(next(iter(values.values())))
     
-    y1 = 1.0 + model_params['edepth'].value
-    y2 = 1 #- model_params['edepth'].value
-    y3 = 1 #- model_params['edepth'].value
-    y4 = 1.0 + model_params['edepth'].value
+    if transitType != 'primary' or ldtype != 'quadratic' or np.any(np.asarray(values['ecc']) != 0):
+        light_curves = np.empty((n_sets, times.size))
+        for k in range(n_sets):
+            bm_params = batman_params({name: value[k] for name, value in values.items()}, init_t0=init_t0, ldtype=ldtype)
+            light_curves[k] = batman_light_curve(bm_params, times, transitType=transitType)
+        
+        return light_curves
     
-    x1_0 = times[t1_0] + delta_eclipse_time
-    x2_0 = times[t2_0] + delta_eclipse_time
-    x1_1 = times[t1_1] + delta_eclipse_time
-    x2_1 = times[t2_1] + delta_eclipse_time
-    x3_0 = times[t3_0] + delta_eclipse_time
-    x4_0 = times[t4_0] + delta_eclipse_time
-    x3_1 = times[t3_1] + delta_eclipse_time
-    x4_1 = times[t4_1] + delta_eclipse_time
+    col = partial(_batch_column, values)
+    rprs = np.sqrt(col('tdepth'))
     
-    ingress_slope_0 = (y2 - y1) / (x2_0 - x1_0)
-    ingress_slope_1 = (y2 - y1) / (x2_1 - x1_1)
+    # Circular orbit: the planet is in front of the star when cos(phase) > 0
+    cos_phase = np.cos(2*np.pi * (times - init_t0 - col('deltaTc')) / col('period'))
+    with np.errstate(invalid='ignore'):
+        ds = col('aprs') * np.sqrt(1.0 - cos_phase**2 * np.sin(np.radians(col('inc')))**2)
     
-    egress_slope_0 = (y3 - y4) / (x3_0 - x4_0)
-    egress_slope_1 = (y3 - y4) / (x3_1 - x4_1)
+    in_transit = (cos_phase > 0) * (ds < 1.0 + rprs)
     
-    trap_model[t2_0:t3_0] = y2
-    trap_model[t2_1:t3_1] = y2
+    # Outside of the transits batman returns exactly 1
+    light_curves = np.ones((n_sets, times.size))
     
-    trap_model[t1_0:t2_0] = ingress_slope_0 * (times[t1_0:t2_0]-x2_0) + y2
-    trap_model[t1_1:t2_1] = ingress_slope_1 * (times[t1_1:t2_1]-x2_1) + y2
-    trap_model[t3_0:t4_0] = egress_slope_0 * (times[t3_0:t4_0]-x3_0) + y3
-    trap_model[t3_1:t4_1] = egress_slope_1 * (times[t3_1:t4_1]-x3_1) + y3
+    shapes = np.hstack([rprs, col('u1'), col('u2')])
+    unique_shapes, group = np.unique(shapes, axis=0, return_inverse=True)
+    for k, (rp, u1, u2) in enumerate(unique_shapes):
+        sets = np.where(group.ravel() == k)[0]
+        mask = in_transit[sets]
+        if not mask.any(): continue
+        
+        block = light_curves[sets]
+        block[mask] = _quadratic_ld._quadratic_ld(np.ascontiguousarray(ds[sets][mask]), rp, u1, u2, 1)
+        light_curves[sets] = block
     
-    return trap_model
+    return light_curves
+
+def compute_batch_model(theta, param_names, model_params, times, include_transit=True,
+                        include_eclipse=True, include_phase_curve=True,
+                        include_polynomial=True, ldtype='quadratic'):
+    """
+        Physical models for many parameter sets at once, e.g. all the walkers of an
+        ensemble sampler.
+        
+        The line, phase curve and eclipse are computed as (n_sets, n_times) arrays;
+        the transits need one batman call per set. The components are combined
+        as in `skywalker.compute_full_model_normal` with the trapezoid eclipse:
+        during each eclipse the phase curve goes down to 1 from its values at
+        first and fourth contact (see `skywalker.add_trap_to_phase_curve_model`),
+        unless no frame falls at the bottom of the eclipse; a flat phase curve
+        is multiplied by the batman eclipse instead. The eclipse is only
+        modelled together with a phase curve.
+        
+        Args:
+            theta: (n_sets, n_params) array of parameter sets.
+            param_names: names of the n_params columns of `theta`.
+            model_params: Parameters() object with the fixed parameters and `tCenter`.
+            times: array of dates.
+            include_transit, include_eclipse, include_phase_curve, include_polynomial:
+                        components of the model; see `skywalker.compute_full_model`.
+            ldtype: limb darkening model of the transit.
+        Returns:
+            (n_sets, n_times) array of physical models.
+    """
+    values = batch_parameter_values(theta, param_names, model_params)
+    n_sets = len(np.atleast_2d(theta))
+    init_t0 = model_params['tCenter'].value
+    
+    if 'tdepth' not in values.keys(): include_transit = False
+    if 'edepth' not in values.keys(): include_eclipse = False
+    if 'intercept' not in values.keys(): include_polynomial = False
+    if 'cosAmp' not in values.keys() and n_harmonics(values.keys()) == 0: include_phase_curve = False
+    
+    physical_model = np.ones((n_sets, times.size))
+    
+    if include_polynomial: physical_model *= line_model_batch(values, times)
+    if include_transit: physical_model *= transit_model_batch(values, times, init_t0, ldtype=ldtype)
+    if not include_phase_curve: return physical_model
+    
+    phase_curve = phase_curve_batch(values, times, init_t0)
+    
+    if include_eclipse:
+        nearest_eclipse = nearest_eclipse_batch(values, times, init_t0)
+        occultation = eclipse_occultation_batch(values, times, init_t0, nearest_eclipse)
+        centers, t14, t23 = nearest_eclipse
+        
+        # Planet flux at the bottom of the eclipse; no trapezoid without any frame there
+        bottom = np.where(occultation >= 1.0, phase_curve, -np.inf).max(axis=1) - 1.0
+        with_trap = (bottom > 0.0) * np.isfinite(bottom)
+        
+        # Phase curve at first (ingress) and fourth (egress) contact of each eclipse
+        first = np.clip(np.searchsorted(times, centers - 0.5*t14), 0, times.size - 1)
+        fourth = np.clip(np.searchsorted(times, centers + 0.5*t14), 0, times.size - 1)
+        edge_model = np.where(times < centers, np.take_along_axis(phase_curve, first, axis=1), 
+                                               np.take_along_axis(phase_curve, fourth, axis=1))
+        
+        trapezoid = np.where(occultation > 0.0, edge_model + (1.0 - edge_model) * occultation, phase_curve)
+        phase_curve = np.where(with_trap[:, None], trapezoid, phase_curve)
+        
+        # A flat phase curve carries the batman eclipse as a separate factor
+        flat = np.all(np.isclose(phase_curve, 1.0), axis=1)
+        if flat.any():
+            flat_values = {name: value[flat] for name, value in values.items()}
+            physical_model[flat] *= transit_model_batch(flat_values, times, init_t0, transitType='secondary') \
+                                        - _batch_column(flat_values, 'edepth')
+    
+    return physical_model * phase_curve
 
-def compute_sensitivity_map(model_params, method, xcenters, ycenters, residuals, knots, nearIndices, xBinSize, yBinSize, ind_kdtree, gw_kdtree, pld_intensities, model):
-    if 'bliss' in method.lower():
-        normFactor = (1/xBinSize) * (1/yBinSize)
-        sensitivity_map = bliss.BLISS(xcenters, ycenters, residuals, knots, nearIndices, xBinSize=xBinSize, yBinSize=xBinSize, normFactor=normFactor)
+def compute_sensitivity_map(model_params, method, xcenters, ycenters, residuals, knots, nearIndices, xBinSize, yBinSize, ind_kdtree, gw_kdtree, pld_intensities, model, bliss_operator=None, pld_solver=None):
+    if 'bliss' in method.lower() and bliss_operator is not None:
+        sensitivity_map = bliss_operator(residuals)
+    elif 'bliss' in method.lower():
+        if len(knots[0]) == 3:
+            raise ValueError('3-D BLISS knots require a `bliss_operator`; see `bliss.BLISS3DOperator`')
+        
+        # Variable size (quadtree) grids pass xBinSize = yBinSize = None
+        normFactor = (1/xBinSize) * (1/yBinSize) if xBinSize is not None and yBinSize is not None else None
+        sensitivity_map = bliss.BLISS(xcenters, ycenters, residuals, knots, nearIndices, xBinSize=xBinSize, yBinSize=yBinSize, normFactor=normFactor)
+    elif 'krdata' in method.lower() and ind_kdtree is None:
+        # `gw_kdtree` is a precompiled operator; see `krdata.kernel_regression_operator`
+        sensitivity_map = gw_kdtree.dot(residuals)
     elif 'krdata' in method.lower():
         sensitivity_map  = np.sum(residuals[ind_kdtree]  * gw_kdtree, axis=1)
+    elif 'pld' in method.lower() and pld_solver is not None:
+        # Coefficients solved in closed form; see `pld.PLDSolver`
+        sensitivity_map = pld_solver(residuals, model)
     elif 'pld' in method.lower():
         PLDcoeffs = [val.value for val in model_params.values() if 'pld' in val.name.lower()]
-        sensitivity_map = np.dot(PLDcoeffs, pld_intensities)
+        
+        if len(PLDcoeffs) > len(pld_intensities):
+            # Raw intensities from `add_pld_params(..., streaming=True)`
+            order = (len(PLDcoeffs) - ('pldBase' in model_params.keys())) // len(pld_intensities)
+            sensitivity_map = pld.pld_dot(np.array(PLDcoeffs), pld_intensities, order=order)
+        else:
+            sensitivity_map = np.dot(PLDcoeffs, pld_intensities)
     else:
         print('INVALID METHOD: ABORT!')
     
-    nSig = 10
-    vbad_sm = np.where(abs(sensitivity_map - np.median(sensitivity_map)) > nSig*scale.mad(sensitivity_map))[0]
-    if len(sensitivity_map)-1 in vbad_sm:
-        vbad_sm = list(set(vbad_sm) - set([len(sensitivity_map)-1]))
-        end_corner_case = True
-    else:
-        end_corner_case = False
-    if 0 in vbad_sm:
-        vbad_sm = list(set(vbad_sm) - set([0]))
-        start_corner_case = True
-    else:
-        start_corner_case = False
+    return clip_sensitivity_map(sensitivity_map)
+
+def clip_sensitivity_map(sensitivity_map, nSig=10):
+    """
+        Replace the points of the sensitivity map more than `nSig` MADs away from
+        its median by the mean of their neighbours.
+        
+        Args:
+            sensitivity_map: (n_times,) sensitivity map, or (n_sets, n_times) array
+                        of maps that are clipped independently.
+            nSig: clipping threshold in units of the MAD.
+        Returns:
+            clipped sensitivity map(s).
+    """
+    ndim = np.ndim(sensitivity_map)
+    sensitivity_map = np.array(sensitivity_map, dtype=float, ndmin=2)
     
-    vbad_sm = np.array(vbad_sm)
-    sensitivity_map[vbad_sm] = 0.5*(sensitivity_map[vbad_sm-1] + sensitivity_map[vbad_sm+1])
+    median = np.median(sensitivity_map, axis=1)[:, None]
+    mad = scale.mad(sensitivity_map, axis=1)[:, None]
+    vbad_sm = abs(sensitivity_map - median) > nSig*mad
     
-    if end_corner_case: sensitivity_map[-1] = sensitivity_map[2]
-    if start_corner_case: sensitivity_map[0] = sensitivity_map[1]
-
-    return sensitivity_map
+    clipped = sensitivity_map.copy()
+    clipped[:, 1:-1] = np.where(vbad_sm[:, 1:-1], 0.5*(sensitivity_map[:, :-2] + sensitivity_map[:, 2:]), 
+                                sensitivity_map[:, 1:-1])
+    
+    # End points: the last one takes the third value and the first one the second
+    clipped[vbad_sm[:, -1], -1] = clipped[vbad_sm[:, -1], 2]
+    clipped[vbad_sm[:, 0], 0] = clipped[vbad_sm[:, 0], 1]
+    
+    return clipped[0] if ndim == 1 else clipped
 
 def add_line_params(model_params, phase, times, transitType='primary'):
 
@@ -310,20 +824,54 @@ def add_line_params(model_params, phase, times, transitType='primary'):
     
     return model_params, transit_indices
 
+def check_streaming_basis(pld_intensities, n_pld, do_pca, do_ica, do_std):
+    if do_pca or do_ica or do_std:
+        raise ValueError('`streaming` uses the raw polynomial basis; set do_pca = do_ica = do_std = False')
+    
+    if len(pld_intensities) != n_pld:
+        raise ValueError('`streaming` expects the ({}, N) normalized pixel intensities'.format(n_pld))
+
 def add_pld_params(model_params, fluxes, pld_intensities, 
                     n_pld = 9, order=3, add_unity = True, 
                     do_pca=True, do_ica=False, do_std=True, 
                     pca_cut=False, n_ppm = 1.0, start_unity=False, 
-                    verbose=False):
+                    vary=True, pld_basis=None, streaming=False, verbose=False):
     
-    # Make a local copy
-    pld_intensities = pld_intensities.copy()
+    if streaming:
+        # Raw polynomial basis, generated in blocks by `pld.pld_lstsq` here and 
+        #   by `pld.pld_dot` in `compute_sensitivity_map`; the (n_pld, N) 
+        #   intensities are returned instead of the design matrix
+        check_streaming_basis(pld_intensities, n_pld, do_pca, do_ica, do_std)
+        
+        n_pld_out = n_pld*order
+        pld_coeffs = pld.pld_lstsq(pld_intensities, fluxes, order=order, add_unity=add_unity) if not start_unity else np.ones(n_pld_out + add_unity) / (n_pld_out + add_unity)
+        
+        for k in range(n_pld_out): model_params.add_many(('pld{}'.format(k), pld_coeffs[k], vary))
+        if add_unity: model_params.add_many(('pldBase', pld_coeffs[n_pld_out], vary))
+        
+        if verbose: [print('{:5}: {}'.format(val.name, val.value)) for val in model_params.values() if 'pld' in val.name.lower()];
+        
+        return model_params, pld_intensities
     
-    if len(pld_intensities) != n_pld * order:
-        pld_intensities = np.vstack([list(pld_intensities**k) for k in range(1,order+1)])
+    if pld_basis is not None:
+        # Fit the (cached) basis once and reuse it; see `pld.PLDBasis`
+        if not pld_basis.fitted: pld_basis.fit(pld_intensities)
+        
+        pld_intensities = pld_basis.transform(pld_intensities)
+        n_pld_out = pld_basis.n_components
+        add_unity = pld_basis.add_unity
+        
+        pld_coeffs = np.linalg.lstsq(pld_intensities.T, fluxes)[0] if not start_unity else np.ones(pld_intensities.shape[0]) / pld_intensities.shape[0]
+        
+        for k in range(n_pld_out): model_params.add_many(('pld{}'.format(k), pld_coeffs[k], vary))
+        if add_unity: model_params.add_many(('pldBase', pld_coeffs[n_pld_out], vary))
+        
+        if verbose: [print('{:5}: {}'.format(val.name, val.value)) for val in model_params.values() if 'pld' in val.name.lower()];
+        
+        return model_params, pld_intensities
     
-    # check that the second set is the square of the first set, and so onself.
-    for k in range(order): assert(np.allclose(pld_intensities[:n_pld]**(k+1), pld_intensities[k*n_pld:(k+1)*n_pld]))
+    # Powers of the intensities, as a new array; see `pld.pld_features`
+    pld_intensities = pld.pld_features(pld_intensities, n_pld, order)
     
     if do_pca or do_ica: do_std = True
     
@@ -358,10 +906,11 @@ def add_pld_params(model_params, fluxes, pld_intensities,
     
     n_pld_out = n_pca if do_pca and pca_cut else n_pld*order
     
-    for k in range(n_pld_out): model_params.add_many(('pld{}'.format(k), pld_coeffs[k], True))
+    # vary=False when the coefficients are solved in closed form by `pld.PLDSolver`
+    for k in range(n_pld_out): model_params.add_many(('pld{}'.format(k), pld_coeffs[k], vary))
     
     # if add_unity: model_params.add_many(('pld{}'.format(n_pld_out), pld_coeffs[n_pld_out], True)) # FINDME: Maybe make min,max = 0,2 or = 0.9,1.1
-    if add_unity: model_params.add_many(('pldBase', pld_coeffs[n_pld_out], True)) # FINDME: Maybe make min,max = 0,2 or = 0.9,1.1
+    if add_unity: model_params.add_many(('pldBase', pld_coeffs[n_pld_out], vary)) # FINDME: Maybe make min,max = 0,2 or = 0.9,1.1
     
     if verbose: [print('{:5}: {}'.format(val.name, val.value)) for val in model_params.values() if 'pld' in val.name.lower()];
     
@@ -371,15 +920,19 @@ def compute_pld_vectors(fluxes, pld_intensities,
                     n_pld = 9, order=3, add_unity = True, 
                     do_pca=True, do_ica=False, do_std=True, 
                     pca_cut=False, n_ppm = 1.0, start_unity=False, 
-                    verbose=False):
+                    pld_basis=None, streaming=False, verbose=False):
     
-    # Make a local copy
-    pld_intensities = pld_intensities.copy()
+    if streaming:
+        # See `add_pld_params`
+        check_streaming_basis(pld_intensities, n_pld, do_pca, do_ica, do_std)
+        return pld_intensities
     
-    if len(pld_intensities) != n_pld * order: pld_intensities = np.vstack([list(pld_intensities**k) for k in range(1,order+1)])
+    if pld_basis is not None:
+        if not pld_basis.fitted: pld_basis.fit(pld_intensities)
+        return pld_basis.transform(pld_intensities)
     
-    # check that the second set is the square of the first set, and so onself.
-    for k in range(order): assert(np.allclose(pld_intensities[:n_pld]**(k+1), pld_intensities[k*n_pld:(k+1)*n_pld]))
+    # Powers of the intensities, as a new array; see `pld.pld_features`
+    pld_intensities = pld.pld_features(pld_intensities, n_pld, order)
     
     if do_pca or do_ica: do_std = True
     
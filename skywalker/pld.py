@@ -1,5 +1,415 @@
 import numpy as np
 
+from sklearn.decomposition import PCA, IncrementalPCA, FastICA
+from sklearn.externals import joblib
+from sklearn.preprocessing import StandardScaler
+
+ppm = 1e6
+
 def normalize_pld(pixel_int):
     pixel_int /= np.sum(pixel_int, axis=0)
     return pixel_int
+
+def ingest_pld(pld_intensities, keep_inds=None, dtype=np.float64, block_size=100000):
+    """
+        Select and normalize the PLD pixel time series in a single pass.
+
+        The frames in `keep_inds` are read from `pld_intensities` one block at
+        a time (so it can be a memory-mapped array), cast to `dtype`,
+        normalized by the total flux of each frame (as in `normalize_pld`)
+        and written into the output, which is the only full-size copy.
+
+        Args:
+        pld_intensities (nDarray): (n_pld, N) or (ny, nx, N) raw pixel
+                                    intensities; may be a memory-mapped array
+        keep_inds (nDarray or None): boolean mask or indices of the frames to
+                                    keep (default: all of them)
+        dtype (dtype): float32 or float64 precision of the output
+        block_size (int): number of frames per block
+        Returns:
+        nDarray: (n_pld, n_keep) normalized pixel intensities
+    """
+    n_frames = pld_intensities.shape[-1]
+    pld_intensities = pld_intensities.reshape(-1, n_frames)
+
+    if keep_inds is None:
+        keep_inds = np.arange(n_frames)
+    elif np.asarray(keep_inds).dtype == bool:
+        keep_inds = np.flatnonzero(keep_inds)
+
+    pixel_int = np.empty((pld_intensities.shape[0], len(keep_inds)), dtype=dtype)
+    for start in range(0, len(keep_inds), block_size):
+        frames = slice(start, min(start + block_size, len(keep_inds)))
+        block = pixel_int[:, frames]
+
+        block[...] = pld_intensities[:, keep_inds[frames]]
+        block /= np.sum(block, axis=0)
+
+    return pixel_int
+
+class PLDSolver(object):
+    """
+        Closed-form solve of the PLD coefficients.
+
+        Given the physical model, the PLD sensitivity map is linear in the
+        coefficients, so they need not be fitted by lmfit or emcee. Each call
+        solves the weighted least-squares problem
+
+            min_c sum(((pld_intensities.T @ c - residuals) * weights)**2)
+
+        with residuals = fluxes / physical_model, and returns the sensitivity
+        map pld_intensities.T @ c.
+
+        The basis is rank deficient by construction: the normalized pixels
+        sum to one, which duplicates the unity (`pldBase`) row. The problem is
+        therefore solved with the SVD of the weighted, column-equilibrated
+        basis, dropping the singular values below `rcond` times the largest;
+        the sensitivity map is unique even though the coefficients are not.
+
+        By default weights = 1 / flux_errs, so the pseudo-inverse is computed
+        once here and each call is a single pass over the basis. With `exact`
+        the weights are physical_model / flux_errs, which matches the
+        chi-squared of `residuals_func` exactly but refactors at every call.
+
+        Args:
+        pld_intensities (nDarray): (n_features, N) PLD basis, as returned by
+                                    `models.add_pld_params`
+        flux_errs (nDarray): photon uncertainties
+        exact (bool): weight by the physical model at every call
+        rcond (float): relative cutoff of the singular values
+    """
+    def __init__(self, pld_intensities, flux_errs, exact=False, rcond=1e-10):
+        self.basis = np.asarray(pld_intensities)
+        self.weights = 1.0 / np.asarray(flux_errs)
+        self.exact = exact
+        self.rcond = rcond
+        self.coeffs = None
+
+        # Column equilibration, so that `rcond` does not depend on the scale
+        #   of each basis vector
+        self.scales = np.sqrt(np.sum(self.basis**2., axis=1))
+        self.scales[self.scales == 0] = 1.0
+
+        if not exact:
+            # (n_features, N) pseudo-inverse of the weighted, scaled design
+            self.pinv = np.linalg.pinv((self.basis / self.scales[:, None] * self.weights).T,
+                                       rcond=rcond) / self.scales[:, None]
+
+    def solve(self, residuals, model=None):
+        """
+            Args:
+            residuals (nDarray): fluxes / physical_model
+            model (nDarray or None): physical model; required if `exact`
+            Returns:
+            nDarray: best fit PLD coefficients
+        """
+        if self.exact:
+            if model is None:
+                raise ValueError('`model` is required by the exact PLD solve')
+
+            weights = self.weights * model
+            design = (self.basis / self.scales[:, None] * weights).T
+            self.coeffs = np.linalg.lstsq(design, residuals * weights,
+                                          rcond=self.rcond)[0] / self.scales
+        else:
+            self.coeffs = np.dot(self.pinv, residuals * self.weights)
+
+        return self.coeffs
+
+    def __call__(self, residuals, model=None):
+        """
+            Args:
+            residuals (nDarray): fluxes / physical_model
+            model (nDarray or None): physical model; required if `exact`
+            Returns:
+            nDarray: PLD sensitivity map at the best fit coefficients
+        """
+        return np.dot(self.solve(residuals, model), self.basis)
+
+def n_pld_features(n_pld=9, order=3, cross_terms=False):
+    """
+        Returns:
+        int: number of PLD features generated by `iter_pld_features`
+    """
+    return n_pld * order + (n_pld * (n_pld - 1) // 2 if cross_terms else 0)
+
+def iter_pld_features(pld_intensities, order=3, cross_terms=False, block_size=10000):
+    """
+        Generate the polynomial PLD features in blocks of frames.
+
+        The powers are built by repeated multiplication of each block of the
+        intensities, so only one (n_features, block_size) block exists at a
+        time. The rows of each block are the powers 1 to `order` of every
+        pixel, followed (if `cross_terms`) by the products of every pair of
+        distinct pixels.
+
+        Args:
+        pld_intensities (nDarray): (n_pld, N) normalized pixel intensities;
+                                    may be a memory-mapped array
+        order (int): highest power of the intensities
+        cross_terms (bool): add the pixel-pair products
+        block_size (int): number of frames per block
+        Returns:
+        generator: (frames, features) with `frames` the slice of frames and
+                    `features` the (n_features, n_frames_in_block) block
+    """
+    n_pld, n_frames = pld_intensities.shape
+    n_features = n_pld_features(n_pld, order, cross_terms)
+    pairs = np.triu_indices(n_pld, 1)
+
+    for start in range(0, n_frames, block_size):
+        frames = slice(start, min(start + block_size, n_frames))
+        block = np.asarray(pld_intensities[:, frames])
+
+        features = np.empty((n_features, block.shape[1]), dtype=block.dtype)
+        features[:n_pld] = block
+        for k in range(1, order):
+            np.multiply(features[(k-1)*n_pld:k*n_pld], block, out=features[k*n_pld:(k+1)*n_pld])
+
+        if cross_terms:
+            np.multiply(block[pairs[0]], block[pairs[1]], out=features[n_pld*order:])
+
+        yield frames, features
+
+def pld_features(pld_intensities, n_pld=9, order=3, cross_terms=False):
+    """
+        Args:
+        pld_intensities (nDarray): (n_pld, N) normalized pixel intensities, or
+                                    (n_features, N) if already expanded
+        n_pld (int): number of pixels
+        order (int): highest power of the intensities
+        cross_terms (bool): add the pixel-pair products
+        Returns:
+        nDarray: (n_features, N) PLD features; see `iter_pld_features`
+    """
+    n_features = n_pld_features(n_pld, order, cross_terms)
+
+    if len(pld_intensities) == n_features and n_features != n_pld:
+        # check that the second set is the square of the first set, and so on
+        for k in range(order): assert(np.allclose(pld_intensities[:n_pld]**(k+1), pld_intensities[k*n_pld:(k+1)*n_pld]))
+
+        return np.array(pld_intensities)
+
+    features = np.empty((n_features, pld_intensities.shape[1]), dtype=pld_intensities.dtype)
+    for frames, block in iter_pld_features(pld_intensities, order, cross_terms):
+        features[:, frames] = block
+
+    return features
+
+def pld_lstsq(pld_intensities, fluxes, flux_errs=None, order=3, cross_terms=False,
+              add_unity=True, block_size=10000, rcond=1e-10):
+    """
+        Weighted least-squares PLD coefficients, accumulated over blocks of
+        `iter_pld_features`.
+
+        The R factor of the QR decomposition of the weighted design matrix
+        (augmented with the target) is updated block by block, so only an
+        (n_coeffs + 1) square matrix is kept between blocks. The small final
+        problem is solved by SVD with the columns equilibrated, which
+        handles the rank deficiency of the basis (the normalized pixels sum
+        to one, like the unity row) without squaring its condition number.
+
+        Args:
+        pld_intensities (nDarray): (n_pld, N) normalized pixel intensities
+        fluxes (nDarray): target of the fit
+        flux_errs (nDarray or None): uncertainties of `fluxes`
+        order, cross_terms, block_size: see `iter_pld_features`
+        add_unity (bool): fit a constant (`pldBase`) term, last
+        rcond (float): relative cutoff of the singular values
+        Returns:
+        nDarray: best fit coefficients
+    """
+    n_pld = pld_intensities.shape[0]
+    n_coeffs = n_pld_features(n_pld, order, cross_terms) + add_unity
+
+    weights = 1.0 / np.asarray(flux_errs) if flux_errs is not None else None
+
+    r_factor = np.zeros((0, n_coeffs + 1))
+    for frames, features in iter_pld_features(pld_intensities, order, cross_terms, block_size):
+        if add_unity: features = np.vstack([features, np.ones(features.shape[1])])
+
+        augmented = np.vstack([features, fluxes[frames]]).T
+        if weights is not None: augmented *= weights[frames, None]
+
+        r_factor = np.linalg.qr(np.vstack([r_factor, augmented]), mode='r')
+
+    design, target = r_factor[:, :n_coeffs], r_factor[:, n_coeffs]
+
+    scales = np.sqrt(np.sum(design**2., axis=0))
+    scales[scales == 0] = 1.0
+
+    return np.linalg.lstsq(design / scales, target, rcond=rcond)[0] / scales
+
+def pld_dot(pld_coeffs, pld_intensities, order=3, cross_terms=False, block_size=10000):
+    """
+        Sensitivity map `pld_coeffs @ features`, accumulated over blocks of
+        `iter_pld_features`.
+
+        Args:
+        pld_coeffs (nDarray): coefficients, with the constant term last if
+                                there is one more than the number of features
+        pld_intensities (nDarray): (n_pld, N) normalized pixel intensities
+        order, cross_terms, block_size: see `iter_pld_features`
+        Returns:
+        nDarray: PLD sensitivity map
+    """
+    n_pld, n_frames = pld_intensities.shape
+    n_features = n_pld_features(n_pld, order, cross_terms)
+
+    sensitivity_map = np.zeros(n_frames)
+    for frames, features in iter_pld_features(pld_intensities, order, cross_terms, block_size):
+        sensitivity_map[frames] = np.dot(pld_coeffs[:n_features], features)
+
+    if len(pld_coeffs) > n_features: sensitivity_map += pld_coeffs[n_features]
+
+    return sensitivity_map
+
+class PLDBasis(object):
+    """
+        Reusable PLD basis: the polynomial features of the pixel intensities,
+        standardized and optionally rotated by PCA and/or FastICA.
+
+        The transforms are fitted once with `fit`, can be stored with `save`
+        and reloaded with `PLDBasis.load`, and are applied to new segments
+        with `transform` without refitting.
+
+        With `incremental`, `fit` streams over blocks of `block_size` frames
+        (e.g. of a memory-mapped intensity array): a first pass accumulates
+        the `StandardScaler` statistics and a second pass feeds an
+        `IncrementalPCA`, so the full (n_pld * order, N) feature matrix is
+        never built. FastICA has no incremental version and is not
+        available in this mode.
+
+        Args:
+        n_pld (int): number of pixels
+        order (int): highest power of the intensities
+        add_unity (bool): append a row of ones (the `pldBase` term)
+        do_pca, do_ica, do_std (bool): apply PCA, FastICA and standard scaling
+        pca_cut (bool): keep only the PCA components needed to explain all
+                        but `n_ppm` ppm of the variance
+        n_ppm (float): see `pca_cut`
+        cross_terms (bool): add the pixel-pair products to the features
+        incremental (bool): fit in blocks with `IncrementalPCA`
+        block_size (int): number of frames per block
+    """
+    def __init__(self, n_pld=9, order=3, add_unity=True, do_pca=True,
+                 do_ica=False, do_std=True, pca_cut=False, n_ppm=1.0,
+                 cross_terms=False, incremental=False, block_size=100000):
+
+        if incremental and do_ica:
+            raise ValueError('FastICA cannot be fitted incrementally; use incremental=False')
+
+        self.n_pld = n_pld
+        self.order = order
+        self.cross_terms = cross_terms
+        self.add_unity = add_unity
+        self.do_pca = do_pca
+        self.do_ica = do_ica
+        self.do_std = do_std or do_pca or do_ica
+        self.pca_cut = pca_cut
+        self.n_ppm = n_ppm
+        self.incremental = incremental
+        self.block_size = block_size
+
+        self.scaler = StandardScaler() if self.do_std else None
+        self.pca = None
+        self.ica = None
+        self.n_pca = None
+        self.fitted = False
+
+    def _blocks(self, n_frames):
+        for start in range(0, n_frames, self.block_size):
+            yield slice(start, min(start + self.block_size, n_frames))
+
+    def _features(self, pld_intensities):
+        return pld_features(pld_intensities, self.n_pld, self.order, self.cross_terms).T
+
+    @property
+    def n_components(self):
+        """
+            Number of basis vectors, without the unity row.
+        """
+        if self.do_pca and self.pca_cut: return self.n_pca
+
+        return n_pld_features(self.n_pld, self.order, self.cross_terms)
+
+    def _set_n_pca(self):
+        evrc = self.pca.explained_variance_ratio_.cumsum()
+        self.n_pca = np.where(evrc > 1.0-self.n_ppm/ppm)[0].min()
+
+    def fit(self, pld_intensities):
+        """
+            Args:
+            pld_intensities (nDarray): (n_pld, N) normalized pixel intensities
+            Returns:
+            self
+        """
+        n_frames = pld_intensities.shape[1]
+
+        if self.incremental:
+            if self.do_std:
+                for frames in self._blocks(n_frames):
+                    self.scaler.partial_fit(self._features(pld_intensities[:, frames]))
+
+            if self.do_pca:
+                self.pca = IncrementalPCA()
+                for frames in self._blocks(n_frames):
+                    features = self._features(pld_intensities[:, frames])
+                    if self.do_std: features = self.scaler.transform(features)
+                    self.pca.partial_fit(features)
+        else:
+            features = self._features(pld_intensities)
+            if self.do_std: features = self.scaler.fit_transform(features)
+
+            if self.do_pca:
+                self.pca = PCA()
+                features = self.pca.fit_transform(features)
+                self._set_n_pca()
+                if self.pca_cut: features = features[:, :self.n_pca]
+
+            if self.do_ica:
+                self.ica = FastICA()
+                self.ica.fit(features)
+
+        if self.do_pca and self.n_pca is None: self._set_n_pca()
+
+        self.fitted = True
+
+        return self
+
+    def _transform_block(self, pld_intensities):
+        features = self._features(pld_intensities)
+        if self.do_std: features = self.scaler.transform(features)
+        if self.do_pca: features = self.pca.transform(features)[:, :self.n_components]
+        if self.do_ica: features = self.ica.transform(features)
+
+        return features
+
+    def transform(self, pld_intensities):
+        """
+            Args:
+            pld_intensities (nDarray): (n_pld, N) normalized pixel intensities
+            Returns:
+            nDarray: (n_components [+ 1], N) PLD basis vectors, with a last row
+                        of ones if `add_unity`
+        """
+        if not self.fitted:
+            raise ValueError('The PLD basis must be fitted before it is applied')
+
+        n_frames = pld_intensities.shape[1]
+
+        basis = np.ones((self.n_components + self.add_unity, n_frames))
+        for frames in self._blocks(n_frames):
+            basis[:self.n_components, frames] = self._transform_block(pld_intensities[:, frames]).T
+
+        return basis
+
+    def fit_transform(self, pld_intensities):
+        return self.fit(pld_intensities).transform(pld_intensities)
+
+    def save(self, filename):
+        joblib.dump(self, filename)
+
+    @classmethod
+    def load(cls, filename):
+        return joblib.load(filename)
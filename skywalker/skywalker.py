@@ -29,6 +29,7 @@ from scipy.interpolate import CubicSpline
 from sklearn.externals import joblib
 from functools import partial
 from lmfit import Parameters, Minimizer, report_errors
+from multiprocessing import Pool, cpu_count
 from scipy import spatial
 from scipy.interpolate import CubicSpline
 from statsmodels.robust import scale
@@ -44,51 +45,21 @@ zero = 0.0
 def add_cubicspline_to_phase_curve_model(model_params, times, init_t0, 
 										phase_curve_model, eclipse_model):
 	
-	ecl_bottom = eclipse_model == eclipse_model.min()
-	in_eclipse = eclipse_model < eclipse_model.max()
-	
-	eclipse0 = in_eclipse * (times < times.mean())
-	eclipse1 = in_eclipse * (times > times.mean())
-	
-	t1_0 = np.where(eclipse0)[0][0]
-	t2_0 = np.where(eclipse0*ecl_bottom)[0][0]
-	t3_0 = np.where(eclipse0*ecl_bottom)[0][-1]
-	t4_0 = np.where(eclipse0)[0][-1]
-	
-	t1_1 = np.where(eclipse1)[0][0]
-	t2_1 = np.where(eclipse1*ecl_bottom)[0][0]
-	t3_1 = np.where(eclipse1*ecl_bottom)[0][-1]
-	t4_1 = np.where(eclipse1)[0][-1]
-	
-	y1_0 = phase_curve_model[t1_0]
-	y2_0 = 1 #- model_params['edepth'].value
-	y3_0 = 1 #- model_params['edepth'].value
-	y4_0 = phase_curve_model[t4_0]
-	
-	y1_1 = phase_curve_model[t1_1]
-	y2_1 = 1 #- model_params['edepth'].value
-	y3_1 = 1 #- model_params['edepth'].value
-	y4_1 = phase_curve_model[t4_1]
-	
-	x1_0 = times[t1_0]
-	x2_0 = times[t2_0]
-	x3_0 = times[t3_0]
-	x4_0 = times[t4_0]
-	
-	x1_1 = times[t1_1]
-	x2_1 = times[t2_1]
-	x3_1 = times[t3_1]
-	x4_1 = times[t4_1]
-	
-	ecl_top = np.where(eclipse_model == eclipse_model.max())[0]
+	# Contact points of every eclipse; `eclipse_model` is no longer scanned
+	occultation = models.trapezoid_occultation(times, 
+						models.eclipse_contact_points(model_params, times, init_t0))
+	
+	ecl_bottom = occultation >= 1.0
+	in_eclipse = occultation > 0.0
+	
+	ecl_top = np.where(~in_eclipse)[0]
 	ecl_bottom = np.where(ecl_bottom)[0]
 	
 	cs_idx = np.sort(np.hstack([ecl_top, ecl_bottom]))
 	
 	output_model = phase_curve_model.copy()
 	
-	output_model[t2_0:t3_0] = y2_0 # == 1.0
-	output_model[t2_1:t3_1] = y2_1 # == 1.0
+	output_model[ecl_bottom] = 1 #- model_params['edepth'].value
 	
 	cs_local = CubicSpline(times[cs_idx], output_model[cs_idx])
 	print("THIS IS BROKEN")
@@ -96,60 +67,33 @@ def add_cubicspline_to_phase_curve_model(model_params, times, init_t0,
 
 def add_trap_to_phase_curve_model(model_params, times, init_t0, 
 								phase_curve_model, eclipse_model):
+	'''
+		Replace the phase curve during every eclipse by a trapezoid from its 
+			value at first contact down to 1 (the star alone) between 
+			second and third contact, and back up to its value at fourth 
+			contact.
+		
+		The contact points are computed analytically (see 
+			`models.contact_points`); `eclipse_model` is unused and kept for 
+			backwards compatibility.
+	'''
+	contacts = models.eclipse_contact_points(model_params, times, init_t0)
+	if len(contacts) == 0: return phase_curve_model.copy()
 	
-	ecl_bottom = eclipse_model == eclipse_model.min()
-	in_eclipse = eclipse_model < eclipse_model.max()
-	
-	eclipse0 = in_eclipse * (times < times.mean())
-	eclipse1 = in_eclipse * (times > times.mean())
-	
-	t1_0 = np.where(eclipse0)[0][0]
-	t2_0 = np.where(eclipse0*ecl_bottom)[0][0]
-	t3_0 = np.where(eclipse0*ecl_bottom)[0][-1]
-	t4_0 = np.where(eclipse0)[0][-1]
-	
-	t1_1 = np.where(eclipse1)[0][0]
-	t2_1 = np.where(eclipse1*ecl_bottom)[0][0]
-	t3_1 = np.where(eclipse1*ecl_bottom)[0][-1]
-	t4_1 = np.where(eclipse1)[0][-1]
-	
-	y1_0 = phase_curve_model[t1_0]
-	y2_0 = 1 #- model_params['edepth'].value
-	y3_0 = 1 #- model_params['edepth'].value
-	y4_0 = phase_curve_model[t4_0]
-	
-	y1_1 = phase_curve_model[t1_1]
-	y2_1 = 1 #- model_params['edepth'].value
-	y3_1 = 1 #- model_params['edepth'].value
-	y4_1 = phase_curve_model[t4_1]
-	
-	x1_0 = times[t1_0]
-	x2_0 = times[t2_0]
-	x3_0 = times[t3_0]
-	x4_0 = times[t4_0]
-	
-	x1_1 = times[t1_1]
-	x2_1 = times[t2_1]
-	x3_1 = times[t3_1]
-	x4_1 = times[t4_1]	
-	
-	ingress_slope_0 = (y2_0 - y1_0) / (x2_0 - x1_0)
-	ingress_slope_1 = (y2_1 - y1_1) / (x2_1 - x1_1)
-	
-	egress_slope_0 = (y4_0 - y3_0) / (x4_0 - x3_0)
-	egress_slope_1 = (y4_1 - y3_1) / (x4_1 - x3_1)
-	
-	output_model = phase_curve_model.copy()
+	occultation = models.trapezoid_occultation(times, contacts)
 	
-	output_model[t2_0:t3_0] = y2_0 # == 1.0
-	output_model[t2_1:t3_1] = y2_1 # == 1.0
+	# Phase curve at first (ingress) and fourth (egress) contact of each eclipse
+	edges = phase_curve_model[np.clip(np.searchsorted(times, contacts), 0, 
+															times.size - 1)]
+	edges[:,1] = edges[:,0]
+	edges[:,2] = edges[:,3]
+	edge_model = np.interp(times, contacts.ravel(), edges.ravel())
 	
-	output_model[t1_0:t2_0] = ingress_slope_0 * (times[t1_0:t2_0]-x2_0) + y2_0
-	output_model[t1_1:t2_1] = ingress_slope_1 * (times[t1_1:t2_1]-x2_1) + y2_1
-	output_model[t3_0:t4_0] = egress_slope_0 * (times[t3_0:t4_0]-x3_0) + y3_0
-	output_model[t3_1:t4_1] = egress_slope_1 * (times[t3_1:t4_1]-x3_1) + y3_1
+	y_bottom = 1 #- model_params['edepth'].value
 	
-	return output_model
+	return np.where(occultation > 0.0, 
+					edge_model + (y_bottom - edge_model) * occultation, 
+					phase_curve_model)
 
 def instantiate_system(planet_input, fpfs=0.0, 
 						u_params = [0.0, 0.0],
@@ -411,7 +355,9 @@ def compute_full_model_normal(model_params, times, include_transit = True,
 	if 'tdepth' not in model_params.keys(): include_transit = False
 	if 'edepth' not in model_params.keys(): include_eclipse = False
 	if 'intercept' not in model_params.keys(): include_polynomial = False
-	if 'cosAmp' not in model_params.keys(): include_phase_curve = False
+	if 'cosAmp' not in model_params.keys() \
+		and models.n_harmonics(model_params.keys()) == 0: 
+		include_phase_curve = False
 	
 	if include_polynomial:
 		line_model = models.line_model_func(model_params, times) 
@@ -441,8 +387,6 @@ def compute_full_model_normal(model_params, times, include_transit = True,
 	if subtract_edepth: 
 		eclipse_model = eclipse_model - model_params['edepth'].value
 	
-	where_eclipse = np.where(eclipse_model < eclipse_model.max())[0]
-	
 	ecl_bottom = eclipse_model == eclipse_model.min()
 	# model_params['edepth'].value = phase_curve_model[ecl_bottom].mean() - 1.0
 	
@@ -546,6 +490,38 @@ def compute_full_model(model_params, times, planet_info=None,
 									use_trap = use_trap, 
 									verbose = verbose)
 
+def weirdness_model(model_params, times, values=None):
+	'''
+		Linear ramp `weirdslope * t + weirdintercept` after `t_start` 
+			(t relative to the mean time), or 1.0 if the parameters are not 
+			in `model_params`
+		
+		Inputs
+			values: dict of (n_sets,) arrays from 
+						`models.batch_parameter_values`; if given, returns 
+						an (n_sets, n_times) array
+	'''
+	# If all 3 keys exists, then trigger weirdness vector
+	weird_cond = True
+	for key in ['t_start', 'weirdslope' 'weirdintercept']:
+		weird_cond = weird_cond * key in model_params.keys()
+	
+	if not weird_cond: return 1.0
+	
+	batch = values is not None
+	if not batch:
+		values = {key: model_params[key].value 
+					for key in ['t_start', 'weirdslope', 'weirdintercept']}
+	
+	t_start, weirdslope_, weirdintercept_ = [np.reshape(values[key], (-1, 1)) 
+					for key in ['t_start', 'weirdslope', 'weirdintercept']]
+	
+	cond_time_ = times - times.mean()
+	weirdness = np.where(cond_time_ > t_start, 
+							weirdslope_*cond_time_ + weirdintercept_, 1.0)
+	
+	return weirdness if batch else weirdness[0]
+
 def residuals_func(model_params, times, xcenters, ycenters, fluxes, flux_errs, 
 				keep_inds, planet=None, star=None, system=None, 
 				planet_info=None, knots=None, method=None, nearIndices=None, 
@@ -555,7 +531,8 @@ def residuals_func(model_params, times, xcenters, ycenters, fluxes, flux_errs,
 				include_phase_curve = True, include_polynomial = True, 
 				testing_model = False, eclipse_option = 'trapezoid', 
 				use_trap = False, interpolate=False, interp_ratio=0.1, 
-				fit_function='starry', verbose=False):
+				fit_function='starry', bliss_operator=None, pld_solver=None,
+				verbose=False):
 	
 	start = time()
 	start0 = time()
@@ -596,22 +573,11 @@ def residuals_func(model_params, times, xcenters, ycenters, fluxes, flux_errs,
 											ind_kdtree = ind_kdtree, 
 											gw_kdtree = gw_kdtree, 
 											pld_intensities = pld_intensities, 
-											model = physical_model)
-
-	# If all 3 keys exists, then trigger weirdness vector
-	weird_cond = True
-	for key in ['t_start', 'weirdslope' 'weirdintercept']:
-		weird_cond = weird_cond * key in model_params.keys()
+											model = physical_model,
+											bliss_operator = bliss_operator,
+											pld_solver = pld_solver)
 
-	if weird_cond:
-		weirdness = np.ones(times.size)
-		cond = times - times.mean() > model_params['t_start']
-		cond_time_ = (times[cond]-times.mean())
-		weirdslope_ = model_params['weirdslope']
-		weirdintercept_ = model_params['weirdintercept']
-		weirdness[cond] = weirdslope_*cond_time_ + weirdintercept_
-	else:
-		weirdness = 1.0
+	weirdness = weirdness_model(model_params, times)
 	
 	model = physical_model*sensitivity_map*weirdness
 	# print('Full Res Function took {} seconds'.format(time()-start))
@@ -630,10 +596,72 @@ def residuals_func_multiepoch(model_params, times_list, xcenters_list,
 								include_polynomial=True, 
 								testing_model=False, 
 								eclipse_option='trapezoid', use_trap=False, 
+								fit_function='starry', joint_bliss_operator=None,
 								verbose=False):
+	''' Residuals of a simultaneous fit to several epochs
+		
+		If `joint_bliss_operator` (see `bliss.jointBLISSOperator`) is given, 
+			all epochs share a single BLISS map on a global knot grid, 
+			computed once per call from the residuals of every epoch; 
+			`knots_list` and `nearIndices_list` are then not used.
+	'''
 	
 	model_params_single = model_params.copy()
 	
+	if joint_bliss_operator is not None:
+		physical_full = []
+		for epoch, times in enumerate(times_list):
+			for key in ['intercept', 'slope', 'curvature']:
+				key_epoch = '{}{}'.format(key, epoch)
+				model_params_single[key].value = model_params_single[key_epoch].value
+			
+			# `testing_model` returns the physical model of this epoch only
+			physical_now = residuals_func(model_params_single, times, 
+									xcenters_list[epoch], 
+									ycenters_list[epoch], 
+									fluxes_list[epoch], 
+									flux_errs_list[epoch], 
+									keep_inds_list[epoch], 
+									method = method, 
+									transit_indices = transit_indices, 
+									include_transit = include_transit, 
+									include_eclipse = include_eclipse, 
+									include_phase_curve = include_phase_curve, 
+									include_polynomial = include_polynomial, 
+									testing_model = True, 
+									eclipse_option = eclipse_option, 
+									use_trap = use_trap, 
+									fit_function = fit_function, 
+									verbose = verbose)
+			
+			physical_full.append(physical_now * np.ones(times.size))
+		
+		physical_full = np.concatenate(physical_full)
+		if testing_model: return physical_full
+		
+		fluxes_full = np.concatenate(fluxes_list)
+		flux_errs_full = np.concatenate(flux_errs_list)
+		
+		sensitivity_map = models.compute_sensitivity_map(
+									model_params = model_params_single, 
+									method = 'bliss', 
+									xcenters = None, 
+									ycenters = None, 
+									residuals = fluxes_full / physical_full, 
+									knots = None, 
+									nearIndices = None, 
+									xBinSize = x_bin_size, 
+									yBinSize = y_bin_size, 
+									ind_kdtree = None, 
+									gw_kdtree = None, 
+									pld_intensities = None, 
+									model = physical_full, 
+									bliss_operator = joint_bliss_operator)
+		
+		model_full = physical_full * sensitivity_map
+		
+		return (model_full - fluxes_full) / flux_errs_full
+	
 	model_full = []
 	fluxes_full = []
 	flux_errs_full = []
@@ -673,6 +701,7 @@ def residuals_func_multiepoch(model_params, times_list, xcenters_list,
 									testing_model = testing_model, 
 									eclipse_option = eclipse_option, 
 									use_trap = use_trap, 
+									fit_function = fit_function, 
 									verbose = verbose)
 		
 		model_full.extend(model_now)
@@ -685,6 +714,70 @@ def residuals_func_multiepoch(model_params, times_list, xcenters_list,
 	
 	return (model_full - fluxes_full) / flux_errs_full
 
+def log_probability_batch(theta, param_names, model_params, times, fluxes, 
+							flux_errs, sensitivity_operator=None, 
+							include_transit = True, include_eclipse = True, 
+							include_phase_curve = True, 
+							include_polynomial = True):
+	'''
+		Gaussian log-probability of many parameter sets at once, for the 
+			vectorized mode of an ensemble sampler, e.g.
+			
+			emcee.EnsembleSampler(nwalkers, ndim, log_probability_batch, 
+						vectorize=True, args=(param_names, model_params, ...))
+		
+		Inputs
+			theta: (n_sets, n_params) array of parameter sets
+			param_names: names of the n_params columns of `theta`
+			model_params: lmfit Parameters(); gives the fixed parameters and 
+							the (min, max) bounds of the varied ones
+			times, fluxes, flux_errs: light curve
+			sensitivity_operator: callable mapping the (n_times, n_sets) 
+							residuals to the sensitivity maps, e.g. a 
+							`bliss.BLISSOperator` or the `.dot` of 
+							`krdata.kernel_regression_operator`; None to 
+							fit the physical model alone
+		
+		Returns
+			(n_sets,) log-probabilities; -inf outside the bounds
+		
+		Within the bounds, this is -0.5 * sum(residuals_func(...)**2) with 
+			fit_function = 'normal' and the trapezoid eclipse: the 
+			sensitivity maps are clipped with `models.clip_sensitivity_map` 
+			and multiplied by the `weirdness_model`.
+	'''
+	theta = np.atleast_2d(theta)
+	
+	mins = np.array([model_params[name].min for name in param_names])
+	maxs = np.array([model_params[name].max for name in param_names])
+	in_bounds = np.all((theta >= mins) * (theta <= maxs), axis=1)
+	
+	log_prob = np.full(len(theta), -np.inf)
+	if not in_bounds.any(): return log_prob
+	
+	physical_model = models.compute_batch_model(theta[in_bounds], param_names, 
+									model_params, times, 
+									include_transit = include_transit, 
+									include_eclipse = include_eclipse, 
+									include_phase_curve = include_phase_curve, 
+									include_polynomial = include_polynomial)
+	
+	if sensitivity_operator is not None:
+		sensitivity_map = models.clip_sensitivity_map(
+						sensitivity_operator((fluxes / physical_model).T).T)
+	else:
+		sensitivity_map = 1.0
+	
+	values = models.batch_parameter_values(theta[in_bounds], param_names, 
+															model_params)
+	weirdness = weirdness_model(model_params, times, values)
+	
+	model = physical_model * sensitivity_map * weirdness
+	
+	log_prob[in_bounds] = -0.5*np.sum(((model - fluxes) / flux_errs)**2., axis=1)
+	
+	return log_prob
+
 def map_fit_params(fit_params, fit_param_names, model_params):
 	''' A wrapper helper to convert the params from a scipy.optimize.minimize 
 			to a dictionary (i.e. LMFIT setup).
@@ -750,6 +843,8 @@ def generate_best_fit_solution(model_params, times, xcenters, ycenters, fluxes,
 								include_phase_curve = True, 
 								include_polynomial = True, 
 								eclipse_option = 'trapezoid',
+								bliss_operator = None,
+								pld_solver = None,
 								verbose = False):
 	
 	output = compute_full_model(model_params, times, 
@@ -775,7 +870,9 @@ def generate_best_fit_solution(model_params, times, xcenters, ycenters, fluxes,
 					xBinSize=x_bin_size, yBinSize=y_bin_size, 
 					ind_kdtree=ind_kdtree, gw_kdtree=gw_kdtree, 
 					pld_intensities=pld_intensities, 
-					model=output['physical_model'])
+					model=output['physical_model'],
+					bliss_operator=bliss_operator,
+					pld_solver=pld_solver)
 	
 	weird_cond = True
 	for key in ['t_start', 'weirdslope' 'weirdintercept']:
@@ -795,6 +892,7 @@ def generate_best_fit_solution(model_params, times, xcenters, ycenters, fluxes,
 	
 	output['full_model'] = model
 	output['sensitivity_map'] = sensitivity_map
+	if pld_solver is not None: output['pld_coeffs'] = pld_solver.coeffs
 	output['weirdness'] = weirdness
 	
 	return output
@@ -832,4 +930,133 @@ def generate_best_fit_solution_scipy(fit_params, fit_param_names, model_params,
 									eclipse_option = eclipse_option,
 									verbose = verbose)
 	
-	return output
\ No newline at end of file
+	return output
+
+# Read-only inputs of `bliss_bin_size_sweep`, set once per worker process
+_sweep_inputs = {}
+
+def _init_bin_size_sweep(inputs):
+	global _sweep_inputs
+	_sweep_inputs = inputs
+
+def _fit_bin_size(bin_size):
+	''' Fit the model with BLISS for a single (x_bin_size, y_bin_size) '''
+	x_bin_size, y_bin_size = bin_size
+	
+	start = time()
+	
+	xcenters = _sweep_inputs['xcenters']
+	ycenters = _sweep_inputs['ycenters']
+	fluxes = _sweep_inputs['fluxes']
+	
+	knots = bliss.createGrid(xcenters, ycenters, x_bin_size, y_bin_size)
+	nearIndices = bliss.regularGridIndices(xcenters, ycenters, knots, 
+											x_bin_size, y_bin_size)
+	bliss_operator = bliss.BLISSOperator(xcenters, ycenters, knots, 
+										nearIndices, x_bin_size, y_bin_size)
+	
+	partial_residuals = partial(residuals_func, 
+								times = _sweep_inputs['times'], 
+								xcenters = xcenters, 
+								ycenters = ycenters, 
+								fluxes = fluxes, 
+								flux_errs = _sweep_inputs['flux_errs'], 
+								keep_inds = None, 
+								knots = knots, 
+								nearIndices = nearIndices, 
+								method = 'bliss', 
+								x_bin_size = x_bin_size, 
+								y_bin_size = y_bin_size, 
+								bliss_operator = bliss_operator, 
+								fit_function = _sweep_inputs['fit_function'], 
+								**_sweep_inputs['residuals_kwargs'])
+	
+	fit_result = Minimizer(partial_residuals, 
+							_sweep_inputs['model_params']).leastsq()
+	
+	# Each occupied knot is effectively a free parameter of the fit
+	n_knots = np.count_nonzero(bliss_operator.counts)
+	n_free = fit_result.nvarys + n_knots
+	bic = fit_result.chisqr + n_free * np.log(fluxes.size)
+	
+	return {'x_bin_size': x_bin_size, 
+			'y_bin_size': y_bin_size, 
+			'chisq': fit_result.chisqr, 
+			'bic': bic, 
+			'n_knots': n_knots, 
+			'wall_time': time() - start}
+
+def bliss_bin_size_sweep(model_params, times, xcenters, ycenters, fluxes, 
+						flux_errs, bin_sizes, nCores=None, verbose=False, 
+						fit_function='normal', **residuals_kwargs):
+	''' Fit the model with BLISS over a grid of knot spacings and select the 
+			best one by BIC
+		
+		Inputs
+		------
+			
+			model_params (lmfit.Parameters): initial parameters for each fit
+			
+			times, xcenters, ycenters, fluxes, flux_errs (ndarray): the 
+				(outlier-free) inputs to `residuals_func`
+			
+			bin_sizes (list): the knot spacings to test; either floats 
+				(x_bin_size == y_bin_size) or (x_bin_size, y_bin_size) pairs
+			
+			nCores (int or None): size of the process pool; defaults to 
+				`cpu_count()`; 1 runs the sweep in this process
+			
+			fit_function (str): passed on to `residuals_func`; defaults to 
+				'normal' (batman) rather than the 'starry' default of 
+				`residuals_func`, which would need a starry system
+			
+			residuals_kwargs: passed on to `residuals_func` (e.g. 
+				include_phase_curve=False)
+		
+		Returns
+		-------
+			
+			best_bin_size (tuple): (x_bin_size, y_bin_size) with the lowest BIC
+			
+			results (DataFrame): chisq, BIC (counting each occupied knot as a 
+				free parameter), number of occupied knots and wall time 
+				for every bin size
+	'''
+	bin_sizes = [(bs, bs) if np.isscalar(bs) else tuple(bs) for bs in bin_sizes]
+	
+	inputs = {'model_params': model_params, 
+				'times': times, 
+				'xcenters': xcenters, 
+				'ycenters': ycenters, 
+				'fluxes': fluxes, 
+				'flux_errs': flux_errs, 
+				'fit_function': fit_function, 
+				'residuals_kwargs': residuals_kwargs}
+	
+	if nCores is None: nCores = min(cpu_count(), len(bin_sizes))
+	
+	start = time()
+	if nCores > 1:
+		# With the default `fork` start method, the workers inherit `inputs` 
+		#	without copying them
+		pool = Pool(nCores, initializer=_init_bin_size_sweep, 
+					initargs=(inputs,))
+		
+		results = pool.map(_fit_bin_size, bin_sizes, chunksize=1)
+		
+		pool.close()
+		pool.join()
+	else:
+		_init_bin_size_sweep(inputs)
+		results = [_fit_bin_size(bin_size) for bin_size in bin_sizes]
+	
+	results = DataFrame(results)
+	best = results['bic'].idxmin()
+	best_bin_size = (results['x_bin_size'][best], results['y_bin_size'][best])
+	
+	if verbose:
+		print(results)
+		print('Bin size sweep took {} seconds'.format(time() - start))
+		print('Best bin size: {}'.format(best_bin_size))
+	
+	return best_bin_size, results
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+def make_centroids(n_points=5000, seed=42):
+    rng = np.random.RandomState(seed)
+    xcenters = 15.0 + 0.1 * rng.randn(n_points)
+    ycenters = 15.0 + 0.1 * rng.randn(n_points)
+    npix = (2.5 + 0.1 * rng.randn(n_points))**2
+    fluxes = 1.0 + 1e-3 * rng.randn(n_points) + 1e-2 * (xcenters - 15.0)
+
+    return xcenters, ycenters, npix, fluxes
+
+@pytest.fixture
+def synthetic_centroids():
+    """
+        Factory of synthetic (xcenters, ycenters, npix, fluxes), with fluxes
+        that depend linearly on the x position.
+    """
+    return make_centroids
@@ -0,0 +1,201 @@
+import numpy as np
+import pytest
+
+from scipy import spatial
+
+from .. import bliss
+from .. import cache
+from .. import kernels
+
+def knot_means(nearIndices, fluxes, n_knots):
+    means = np.zeros(n_knots)
+    for knot in range(n_knots):
+        members = nearIndices[:, 0] == knot
+        if members.any(): means[knot] = fluxes[members].mean()
+
+    return means
+
+def loop_knot_means(knots, nearIndices, fluxes):
+    # Per-point loop of the original `associateFluxes`
+    knot_fluxes = [[] for k in knots]
+    for kp in range(len(fluxes)):
+        knot_fluxes[nearIndices[kp][0]].append(fluxes[kp])
+
+    return [np.mean(flux) if len(flux) else 0 for flux in knot_fluxes]
+
+def loop_interpolate(knotFluxes, deltaX1, deltaY1, nearIndices, binSize, normFactor):
+    # Per-point loop of the original `interpolateFlux`
+    interpolated = np.zeros(len(deltaX1))
+    for kp, (dx1, dy1) in enumerate(zip(deltaX1, deltaY1)):
+        nearest = [knotFluxes[i] for i in nearIndices[kp]]
+        if 0 in nearest:
+            interpolated[kp] = knotFluxes[nearIndices[kp][0]]
+            continue
+
+        dx2 = binSize - dx1
+        dy2 = binSize - dy1
+        interpolated[kp] = normFactor * (dx1 * dy2 * nearest[0] + dx2 * dy2 * nearest[1]
+                                         + dx2 * dy1 * nearest[2] + dx1 * dy1 * nearest[3])
+
+    return interpolated
+
+@pytest.fixture(params=['numpy', 'numba'])
+def backend(request):
+    if request.param == 'numba': pytest.importorskip('numba')
+
+    previous = kernels.get_backend()
+    kernels.set_backend(request.param)
+    yield request.param
+    kernels.set_backend(previous)
+
+def test_knot_fluxes_tolerance(backend, synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids(n_points=20000)
+    knots = bliss.createGrid(xcenters, ycenters, 0.02, 0.02)
+    nearIndices = bliss.regularGridIndices(xcenters, ycenters, knots, 0.02, 0.02)
+
+    knotFluxes, knotCounts = bliss.accumulateFluxes(knots, nearIndices, fluxes)
+
+    # Sequential instead of pairwise summation: within the (n - 1) eps bound of
+    #   a sequential sum of n positive terms, not bit-for-bit
+    np.testing.assert_allclose(knotFluxes, loop_knot_means(knots, nearIndices, fluxes), 
+                               rtol=knotCounts.max() * np.finfo(float).eps, atol=0)
+
+def test_interpolate_flux_matches_loop(backend, synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids(n_points=2000)
+    knots = bliss.createGrid(xcenters, ycenters, 0.02, 0.02)
+    nearIndices = bliss.regularGridIndices(xcenters, ycenters, knots, 0.02, 0.02)
+    normFactor = (1/0.02) * (1/0.02)
+
+    knotFluxes = np.array(loop_knot_means(knots, nearIndices, fluxes))
+    deltaX1, deltaY1 = bliss.generate_deltaX_deltaY(xcenters, ycenters, knots, nearIndices)
+
+    # Bit-for-bit for the same knot fluxes
+    np.testing.assert_array_equal(bliss.interpolateFlux(knots, knotFluxes, deltaX1, deltaY1, nearIndices, 
+                                                        0.02, 0.02, normFactor),
+                                  loop_interpolate(knotFluxes, deltaX1, deltaY1, nearIndices, 0.02, normFactor))
+
+def grid_indices(xcenters, ycenters, knots, regular):
+    if regular:
+        return bliss.regularGridIndices(xcenters, ycenters, knots, 0.02, 0.02)
+
+    return bliss.nearestIndices(xcenters, ycenters, spatial.cKDTree(knots))
+
+def test_regular_grid_indices(synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids()
+    knots = np.asarray(bliss.createGrid(xcenters, ycenters, 0.02, 0.02))
+    regular = bliss.regularGridIndices(xcenters, ycenters, knots, 0.02, 0.02)
+    nearest = bliss.nearestIndices(xcenters, ycenters, spatial.cKDTree(knots))
+
+    # The nearest knot is the one of the KDTree query
+    np.testing.assert_array_equal(regular[:, 0], nearest[:, 0])
+
+    # The four knots are the corners of the cell enclosing each point, nearest first;
+    #   points past the last row or column of knots use the last full cell
+    corners = knots[regular]
+    inside = (xcenters <= knots[:, 0].max()) * (ycenters <= knots[:, 1].max())
+    assert inside.mean() > 0.99
+    for axis, centers in enumerate([xcenters, ycenters]):
+        np.testing.assert_allclose(np.ptp(corners[:, :, axis], axis=1), 0.02, rtol=1e-9)
+        assert np.all(corners[inside, :, axis].min(axis=1) <= centers[inside] + 1e-12)
+        assert np.all(centers[inside] <= corners[inside, :, axis].max(axis=1) + 1e-12)
+
+    distances = np.sum((corners - np.transpose([xcenters, ycenters])[:, None])**2, axis=2)
+    assert np.all(np.diff(distances, axis=1) >= 0)
+
+    # Away from the corners, the KDTree also returns the cell corners
+    same = np.all(np.sort(regular, axis=1) == np.sort(nearest, axis=1), axis=1)
+    assert same.mean() > 0.5
+    np.testing.assert_array_equal(regular[same], nearest[same])
+
+@pytest.mark.parametrize('regular', [True, False])
+def test_bliss_operator(regular, synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids()
+    knots = bliss.createGrid(xcenters, ycenters, 0.02, 0.02)
+    nearIndices = grid_indices(xcenters, ycenters, knots, regular)
+
+    operator = bliss.BLISSOperator(xcenters, ycenters, knots, nearIndices, 0.02, 0.02)
+    expected = bliss.BLISS(xcenters, ycenters, fluxes, knots, nearIndices, 
+                           0.02, 0.02, (1/0.02) * (1/0.02))
+
+    np.testing.assert_allclose(operator.knotFluxes(fluxes), 
+                               knot_means(nearIndices, fluxes, len(knots)), rtol=1e-12)
+    np.testing.assert_allclose(operator(fluxes), expected, rtol=1e-12)
+
+def test_joint_bliss_operator(synthetic_centroids):
+    # Two epochs on overlapping regions of the pixel
+    epochs = [synthetic_centroids(seed=seed) for seed in [0, 1]]
+    xcenters_list = [xcenters + 0.05 * k for k, (xcenters, _, _, _) in enumerate(epochs)]
+    ycenters_list = [ycenters for _, ycenters, _, _ in epochs]
+    fluxes = np.concatenate([fluxes for _, _, _, fluxes in epochs])
+
+    operator = bliss.jointBLISSOperator(xcenters_list, ycenters_list, 0.02, 0.02)
+
+    xcenters, ycenters = np.concatenate(xcenters_list), np.concatenate(ycenters_list)
+    knots = bliss.createGrid(xcenters, ycenters, 0.02, 0.02)
+    nearIndices = bliss.regularGridIndices(xcenters, ycenters, knots, 0.02, 0.02)
+
+    # Every knot pools the frames of both epochs on one global grid
+    np.testing.assert_allclose(operator.knotFluxes(fluxes), 
+                               knot_means(nearIndices, fluxes, len(knots)), rtol=1e-12)
+    np.testing.assert_allclose(operator(fluxes), 
+                               bliss.BLISS(xcenters, ycenters, fluxes, knots, nearIndices, 
+                                           0.02, 0.02, (1/0.02) * (1/0.02)), rtol=1e-12)
+
+    epoch = np.repeat([0, 1], [len(x) for x in xcenters_list])
+    shared = np.array([np.unique(epoch[nearIndices[:, 0] == knot]).size == 2 
+                        for knot in np.unique(nearIndices[:, 0])])
+    assert shared.mean() > 0.5
+
+def test_bliss_operator_quadtree(synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids()
+    knots, nearIndices = bliss.createQuadtreeGrid(xcenters, ycenters, 0.02, 0.02, minFrames=20)
+
+    operator = bliss.BLISSOperator(xcenters, ycenters, knots, nearIndices, None, None)
+    expected = bliss.BLISS(xcenters, ycenters, fluxes, knots, nearIndices, None, None)
+
+    np.testing.assert_allclose(operator(fluxes), expected, rtol=1e-12)
+
+@pytest.mark.parametrize('minFrames', [20, 100])
+def test_quadtree_min_frames(minFrames, synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids()
+    knots, nearIndices = bliss.createQuadtreeGrid(xcenters, ycenters, 0.002, 0.002, minFrames=minFrames)
+
+    # Every leaf cell, identified by its 4 corners, keeps at least minFrames centers
+    cells, counts = np.unique(np.sort(nearIndices, axis=1), axis=0, return_counts=True)
+    assert len(cells) > 1
+    assert counts.min() >= minFrames
+
+def test_bliss_3d_operator(synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids()
+    binSizes = np.array([0.02, 0.02, 0.02])
+    knots, nearIndices = bliss.createVoxelGrid(xcenters, ycenters, npix, *binSizes)
+    operator = bliss.BLISS3DOperator(xcenters, ycenters, npix, knots, nearIndices, *binSizes)
+
+    points = np.transpose([xcenters, ycenters, np.sqrt(npix)])
+    cells = np.unique(np.floor((points - points.min(axis=0)) / binSizes), axis=0)
+    assert len(knots) <= 8 * len(cells)
+
+    np.testing.assert_allclose(operator.knotFluxes(fluxes), 
+                               knot_means(nearIndices, fluxes, len(knots)), rtol=1e-12)
+
+    # Trilinear interpolation is exact for a linear function of the knots
+    slope = np.array([1.0, -2.0, 0.5])
+    interpolated = operator.interpolation.dot(knots.dot(slope))
+    full = (operator.counts[nearIndices] > 0).all(axis=1)
+    assert full.any()
+    np.testing.assert_allclose(interpolated[full], points[full].dot(slope), rtol=1e-12)
+
+def test_voxel_grid_cache_key(tmpdir, synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids()
+    keep_inds = np.arange(len(xcenters))
+
+    key = cache.artifact_key(xcenters, ycenters, keep_inds, npix, np_bin_size=0.02)
+    assert key != cache.artifact_key(xcenters, ycenters, keep_inds, 1.1 * npix, np_bin_size=0.02)
+
+    knots, nearIndices = bliss.createVoxelGrid(xcenters, ycenters, npix, 0.02, 0.02, 0.02)
+    artifacts = cache.ArtifactCache(str(tmpdir))
+    artifacts.save(key, knots=knots, nearIndices=nearIndices)
+    cached = artifacts.load(key, ['knots', 'nearIndices'])
+
+    np.testing.assert_array_equal(cached['knots'], knots)
+    np.testing.assert_array_equal(cached['nearIndices'], nearIndices)
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+from .. import cache
+
+def test_artifact_cache_eviction(tmpdir):
+    arr = np.arange(1000, dtype=float)
+    artifacts = cache.ArtifactCache(str(tmpdir), max_bytes=2.5 * arr.nbytes)
+
+    for k, key in enumerate(['a', 'b']):
+        artifacts.save(key, arr=arr)
+        os.utime(os.path.join(str(tmpdir), key), (k, k))
+
+    # Using 'a' makes 'b' the least recently used entry
+    assert artifacts.load('a', ['arr']) is not None
+    artifacts.save('c', arr=arr)
+
+    assert artifacts.load('b', ['arr']) is None
+    assert sorted(key for _, _, key in artifacts.entries()) == ['a', 'c']
+
+    # The entry just stored is kept even if it alone exceeds max_bytes
+    artifacts.save('d', arr=np.zeros(4000))
+    assert [key for _, _, key in artifacts.entries()] == ['d']
+
+def test_artifact_cache_replace(tmpdir):
+    artifacts = cache.ArtifactCache(str(tmpdir))
+
+    artifacts.save('key', arr=np.zeros(10))
+    old = artifacts.load('key', ['arr'])['arr']
+    artifacts.save('key', arr=np.ones(10))
+
+    np.testing.assert_array_equal(artifacts.load('key', ['arr'])['arr'], np.ones(10))
+    np.testing.assert_array_equal(old, np.zeros(10))
+    assert os.listdir(str(tmpdir)) == ['key']
+
+def test_artifact_cache_failed_rename(tmpdir, monkeypatch):
+    artifacts = cache.ArtifactCache(str(tmpdir))
+    artifacts.save('key', arr=np.zeros(10))
+
+    rename = os.rename
+    def failing_rename(src, dst):
+        if '.tmp' in os.path.basename(src) and not src.endswith('.old'):
+            raise OSError('entry exists')
+        rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', failing_rename)
+    artifacts.save('key', arr=np.ones(10))
+
+    # The existing entry stays in place and no temporary directory is left
+    np.testing.assert_array_equal(artifacts.load('key', ['arr'])['arr'], np.zeros(10))
+    assert os.listdir(str(tmpdir)) == ['key']
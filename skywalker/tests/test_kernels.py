@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+from scipy import spatial
+
+pytest.importorskip('numba')
+
+from .. import bliss
+from .. import kernels
+from .. import krdata
+
+def run_backends(function):
+    outputs = {}
+    previous = kernels.get_backend()
+    try:
+        for name in ['numpy', 'numba']:
+            kernels.set_backend(name)
+            outputs[name] = function()
+    finally:
+        kernels.set_backend(previous)
+
+    return outputs['numpy'], outputs['numba']
+
+def test_knot_fluxes(synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids(n_points=10000)
+    knots = bliss.createGrid(xcenters, ycenters, 0.02, 0.02)
+    nearIndices = bliss.regularGridIndices(xcenters, ycenters, knots, 0.02, 0.02)
+
+    numpy_output, numba_output = run_backends(
+                        lambda: bliss.accumulateFluxes(knots, nearIndices, fluxes))
+
+    np.testing.assert_allclose(numba_output[0], numpy_output[0], rtol=0, atol=1e-12)
+
+def test_bliss_map(synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids(n_points=10000)
+    knots = bliss.createGrid(xcenters, ycenters, 0.02, 0.02)
+    nearIndices = bliss.regularGridIndices(xcenters, ycenters, knots, 0.02, 0.02)
+
+    numpy_output, numba_output = run_backends(
+                        lambda: bliss.BLISS(xcenters, ycenters, fluxes, knots, nearIndices,
+                                            0.02, 0.02, (1/0.02) * (1/0.02)))
+
+    np.testing.assert_allclose(numba_output, numpy_output, rtol=0, atol=1e-12)
+
+def test_krdata_weights(synthetic_centroids):
+    xcenters, ycenters, npix, fluxes = synthetic_centroids(n_points=10000)
+    points = np.transpose([xcenters, ycenters, np.sqrt(npix)])
+    inds = spatial.cKDTree(points).query(points, 51)[1][:, 1:]
+
+    numpy_output, numba_output = run_backends(
+                        lambda: krdata.gaussian_weights_and_nearest_neighbors(
+                                    xcenters, ycenters, np.sqrt(npix), inds))
+
+    np.testing.assert_allclose(numba_output, numpy_output, rtol=0, atol=1e-12)
+
+def test_set_backend():
+    with pytest.raises(ValueError):
+        kernels.set_backend('fortran')
+
+def test_default_backend():
+    assert kernels.get_backend() == 'numpy'
+
+def cached_kernels(directory):
+    return sorted(filename for _, _, filenames in os.walk(directory)
+                    for filename in filenames if filename.endswith('.nbi'))
+
+@pytest.mark.parametrize('cache', [False, True])
+def test_kernel_cache(cache, tmpdir, monkeypatch):
+    numba = pytest.importorskip('numba')
+    monkeypatch.setattr(numba.config, 'CACHE_DIR', str(tmpdir))
+
+    package_dir = os.path.join(os.path.dirname(kernels.__file__), '__pycache__')
+    package_kernels = cached_kernels(package_dir)
+
+    previous = kernels.get_backend()
+    try:
+        kernels.set_backend('numba', cache=cache)
+        kernels.knot_sums_and_counts(np.array([0, 1, 1]), np.ones(3), 2)
+    finally:
+        kernels.set_backend(previous)
+
+    # Nothing is written to the package; the opt-in cache goes to NUMBA_CACHE_DIR
+    assert cached_kernels(package_dir) == package_kernels
+    assert bool(cached_kernels(str(tmpdir))) == cache
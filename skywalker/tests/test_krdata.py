@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from scipy import spatial
+
+from .. import krdata
+
+def synthetic_neighbors(n_points=5000, n_nbr=50, seed=42):
+    rng = np.random.RandomState(seed)
+    xpos = 0.1 * rng.randn(n_points)
+    ypos = 0.1 * rng.randn(n_points)
+    np0 = 0.1 * rng.randn(n_points)
+    residuals = 1.0 + 1e-3 * rng.randn(n_points)
+
+    kdtree = spatial.cKDTree(np.transpose([xpos, ypos, np0]) * 1000.)
+    inds = krdata.query_nearest_neighbors(kdtree, kdtree.data, n_nbr)
+    weights = krdata.gaussian_weights_batched(xpos, ypos, np0, inds)
+
+    return xpos, ypos, np0, residuals, kdtree, inds, weights
+
+@pytest.mark.parametrize('workers', [1, -1])
+def test_query_nearest_neighbors(workers):
+    xpos, ypos, np0, residuals, kdtree, inds, weights = synthetic_neighbors(n_points=2000)
+
+    reference = kdtree.query(kdtree.data, 51)[1][:, 1:]
+    neighbors = krdata.query_nearest_neighbors(kdtree, kdtree.data, 50, workers=workers)
+
+    assert neighbors.dtype == np.int32
+    np.testing.assert_array_equal(neighbors, reference)
+
+@pytest.mark.parametrize('chunk_size', [10000, 777])
+def test_gaussian_weights_batched(chunk_size):
+    xpos, ypos, np0, residuals, kdtree, inds, weights = synthetic_neighbors(n_points=2000)
+
+    batched = krdata.gaussian_weights_batched(xpos, ypos, np0, inds, chunk_size=chunk_size)
+    loop = np.array([krdata.find_qhull_one_point(point, xpos, ypos, np0, inds) 
+                        for point in range(len(xpos))])
+
+    np.testing.assert_allclose(batched, loop, rtol=1e-12, atol=1e-15)
+
+    # A row range written into a caller-provided array
+    out = np.full(inds.shape, -1.0)
+    krdata.gaussian_weights_batched(xpos, ypos, np0, inds, chunk_size=chunk_size, out=out, 
+                                    start=500, stop=1500)
+
+    np.testing.assert_array_equal(out[500:1500], batched[500:1500])
+    assert np.all(out[:500] == -1.0) and np.all(out[1500:] == -1.0)
+
+def test_kernel_regression_operator():
+    xpos, ypos, np0, residuals, kdtree, inds, weights = synthetic_neighbors()
+    operator = krdata.kernel_regression_operator(inds, weights)
+
+    np.testing.assert_allclose(operator.dot(residuals), 
+                               np.sum(residuals[inds] * weights, axis=1), rtol=1e-12)
+
+def test_memmap_kernel_regression(tmpdir):
+    xpos, ypos, np0, residuals, kdtree, inds, weights = synthetic_neighbors()
+
+    # A block size that does not divide the number of points
+    streaming = krdata.MemmapKernelRegression(str(tmpdir), len(xpos), inds.shape[1], 
+                                              block_size=1234)
+    streaming.fill(kdtree, xpos, ypos, np0)
+
+    np.testing.assert_array_equal(streaming.inds, inds)
+    np.testing.assert_allclose(streaming.weights, weights, rtol=1e-12)
+    np.testing.assert_allclose(streaming.dot(residuals), 
+                               np.sum(residuals[inds] * weights, axis=1), rtol=1e-12)
+
+    reopened = krdata.MemmapKernelRegression(str(tmpdir), len(xpos), inds.shape[1], mode='r')
+    np.testing.assert_array_equal(reopened.dot(residuals), streaming.dot(residuals))
+
+def test_adaptive_kernel_regression_operator():
+    xpos, ypos, np0, residuals, kdtree, inds, weights = synthetic_neighbors()
+    operator = krdata.kernel_regression_operator(inds, weights)
+
+    # Without truncation, the adaptive operator is the full operator
+    exact = krdata.adaptive_kernel_regression_operator(inds, weights, weight_tol=0.0)
+    np.testing.assert_allclose(exact.toarray(), operator.toarray(), rtol=1e-12, atol=1e-15)
+
+    adaptive = krdata.adaptive_kernel_regression_operator(inds, weights, weight_tol=1e-3)
+    assert adaptive.nnz < operator.nnz
+    np.testing.assert_allclose(np.asarray(adaptive.sum(axis=1)).ravel(), 1.0, rtol=1e-12)
+    np.testing.assert_allclose(adaptive.dot(residuals), operator.dot(residuals), 
+                               atol=2e-3 * abs(residuals).max())
+
+def test_gaussian_weights_shared():
+    xpos, ypos, np0, residuals, kdtree, inds, weights = synthetic_neighbors(n_points=2000)
+
+    shared = krdata.gaussian_weights_shared(xpos, ypos, np0, inds, nCores=2)
+    loop = np.array([krdata.find_qhull_one_point(point, xpos, ypos, np0, inds) 
+                        for point in range(len(xpos))])
+
+    np.testing.assert_array_equal(shared, weights)
+    np.testing.assert_allclose(shared, loop, rtol=1e-12, atol=1e-15)
+
+def test_gaussian_weights_shared_failure():
+    xpos, ypos, np0, residuals, kdtree, inds, weights = synthetic_neighbors(n_points=200)
+    segments = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+    # Out of range neighbours make the workers raise
+    with pytest.raises(IndexError):
+        krdata.gaussian_weights_shared(xpos, ypos, np0, inds + len(xpos), nCores=2)
+
+    assert not multiprocessing.active_children()
+    if os.path.isdir('/dev/shm'):
+        assert set(os.listdir('/dev/shm')) <= segments
@@ -0,0 +1,262 @@
+import numpy as np
+import pytest
+
+from lmfit import Parameters
+
+from .. import bliss
+from .. import models
+from .. import skywalker
+
+def model_params(**values):
+    defaults = dict(u1=0.1, u2=0.2, deltaTc=0.05, tdepth=0.01, period=2.0, 
+                    inc=86., aprs=8., edepth=1e-3, ecc=0.0, omega=90., 
+                    tCenter=0.0, cosAmp=1e-3, cosPhase=0.05, night_flux=0.0)
+    defaults.update(values)
+
+    params = Parameters()
+    for name, value in defaults.items(): params.add(name, value)
+
+    return params
+
+# Successive fit iterations: fixed timing, changing shape parameters
+iterations = [dict(), dict(aprs=8.2), dict(inc=85.5, edepth=2e-3), dict(tdepth=0.012, u1=0.3)]
+
+@pytest.mark.parametrize('transitType', ['primary', 'secondary'])
+@pytest.mark.parametrize('ldtype', ['quadratic', 'squareroot'])
+@pytest.mark.parametrize('orbit', [dict(deltaEc=0.02), dict(deltaEc=0.02, ecc=0.1, omega=40.)])
+def test_cached_transit_model(transitType, ldtype, orbit):
+    times = np.linspace(-0.2, 6.2, 20000)
+    models.clear_transit_model_cache()
+
+    for values in iterations:
+        params = model_params(**dict(orbit, **values))
+        cached = models.transit_model_func(params, times, 0.0, ldtype=ldtype, transitType=transitType, 
+                                           use_windows=False)
+        fresh = models.transit_model_func(params, times, 0.0, ldtype=ldtype, transitType=transitType, 
+                                          use_cache=False, use_windows=False)
+
+        np.testing.assert_allclose(cached, fresh, rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize('transitType', ['primary', 'secondary'])
+@pytest.mark.parametrize('orbit', [dict(), dict(deltaEc=0.02), dict(inc=82.), dict(ecc=0.1)])
+def test_windowed_light_curve(transitType, orbit):
+    times = np.linspace(-0.2, 6.2, 50000)
+    models.clear_transit_model_cache()
+
+    # The windowed model is reused through the cache across the iterations
+    for values in iterations:
+        params = model_params(**dict(orbit, **values))
+        windowed = models.transit_model_func(params, times, 0.0, transitType=transitType)
+        full = models.transit_model_func(params, times, 0.0, transitType=transitType, 
+                                         use_cache=False, use_windows=False)
+
+        np.testing.assert_allclose(windowed, full, rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize('values', [dict(), dict(deltaEc=0.01)])
+def test_eclipse_contact_points_match_batman(values):
+    times = np.linspace(-0.2, 3.2, 100000)
+    params = model_params(**values)
+
+    eclipse = models.transit_model_func(params, times, 0.0, transitType='secondary', use_windows=False)
+    in_eclipse = times[eclipse < eclipse.max()]
+
+    contacts = models.eclipse_contact_points(params, times, 0.0)
+    contacts = contacts[(contacts[:,3] > times[0]) * (contacts[:,0] < times[-1])]
+
+    dt = np.median(np.diff(times))
+    assert abs(contacts[0,0] - in_eclipse.min()) < 2*dt
+    assert abs(contacts[-1,3] - in_eclipse.max()) < 2*dt
+
+    trapezoid = models.trapezoid_model(params, times, 0.0)
+    assert abs(trapezoid - eclipse).max() < 0.1 * params['edepth'].value
+
+def test_full_model_flat_phase_curve_keeps_batman_eclipse():
+    times = np.linspace(-0.2, 3.2, 10000)
+    params = model_params(cosAmp=0.0)
+
+    transit = models.transit_model_func(params, times, 0.0)
+    eclipse = models.transit_model_func(params, times, 0.0, transitType='secondary')
+    expected = transit * (eclipse - params['edepth'].value)
+
+    physical_model = skywalker.compute_full_model_normal(params, times)
+    np.testing.assert_allclose(physical_model, expected, rtol=0, atol=1e-15)
+
+@pytest.mark.parametrize('values', [dict(), dict(deltaEc=0.01), dict(cosAmp=0.0), 
+                                    dict(cosAmp1=1e-3, sinAmp1=2e-4, cosAmp2=1e-4), 
+                                    dict(intercept=1.0, slope=1e-4)])
+def test_batch_model_matches_full_model(values):
+    times = np.linspace(-0.2, 6.2, 20000)
+    params = model_params(**values)
+    if 'cosAmp1' in values: 
+        for name in ['cosAmp', 'cosPhase']: params.pop(name)
+
+    param_names = ['deltaTc', 'edepth', 'aprs']
+    theta = [[0.0, 1e-3, 8.0], [0.05, 2e-3, 7.5], [-0.02, 5e-4, 9.0]]
+
+    batch = models.compute_batch_model(theta, param_names, params, times)
+
+    for k, row in enumerate(theta):
+        for name, value in zip(param_names, row): params[name].value = value
+        full = skywalker.compute_full_model_normal(params, times)
+
+        np.testing.assert_allclose(batch[k], full, rtol=0, atol=1e-12)
+
+def test_joint_bliss_multiepoch_residuals():
+    rng = np.random.RandomState(42)
+    times_list = [np.linspace(-0.2, 2.2, 3000), np.linspace(3.8, 6.2, 3000)]
+    xcenters_list = [15.0 + 0.05 * rng.randn(times.size) for times in times_list]
+    ycenters_list = [15.0 + 0.05 * rng.randn(times.size) for times in times_list]
+
+    # The same intercept in both epochs and no trends: the multi-epoch model is
+    #   the single-epoch model of the concatenated data
+    params = model_params(intercept=1.0, slope=0.0, curvature=0.0)
+    for epoch in range(2):
+        for key in ['intercept', 'slope', 'curvature']:
+            params.add('{}{}'.format(key, epoch), params[key].value)
+
+    fluxes_list = [skywalker.compute_full_model_normal(params.copy(), times) 
+                    * (1.0 + 1e-2 * (xcenters - 15.0)) + 1e-4 * rng.randn(times.size) 
+                        for times, xcenters in zip(times_list, xcenters_list)]
+    flux_errs_list = [np.full(times.size, 1e-4) for times in times_list]
+
+    operator = bliss.jointBLISSOperator(xcenters_list, ycenters_list, 0.01, 0.01)
+    joint = skywalker.residuals_func_multiepoch(params.copy(), times_list, xcenters_list, 
+                                                ycenters_list, fluxes_list, flux_errs_list, 
+                                                [None, None], method='bliss', 
+                                                x_bin_size=0.01, y_bin_size=0.01, 
+                                                fit_function='normal', 
+                                                joint_bliss_operator=operator)
+
+    single = skywalker.residuals_func(params.copy(), np.concatenate(times_list), 
+                                      np.concatenate(xcenters_list), np.concatenate(ycenters_list), 
+                                      np.concatenate(fluxes_list), np.concatenate(flux_errs_list), 
+                                      None, method='bliss', x_bin_size=0.01, y_bin_size=0.01, 
+                                      fit_function='normal', bliss_operator=operator)
+
+    assert np.all(np.isfinite(joint))
+    np.testing.assert_allclose(joint, single, rtol=0, atol=1e-8)
+
+@pytest.mark.parametrize('orbit', [dict(), dict(ecc=0.1, omega=40.)])
+def test_transit_model_batch(orbit):
+    times = np.linspace(-0.2, 6.2, 20000)
+    params = model_params(**orbit)
+
+    # Repeated (tdepth, u1) pairs share a limb darkening call
+    param_names = ['deltaTc', 'tdepth', 'u1', 'inc']
+    theta = np.array([[0.0, 0.01, 0.1, 86.], [0.05, 0.012, 0.3, 85.], 
+                      [-0.02, 0.01, 0.1, 88.], [0.01, 0.01, 0.1, 80.]])
+
+    batch = models.transit_model_batch(models.batch_parameter_values(theta, param_names, params), 
+                                       times, 0.0)
+
+    for k, row in enumerate(theta):
+        for name, value in zip(param_names, row): params[name].value = value
+        single = models.transit_model_func(params, times, 0.0, use_cache=False, use_windows=False)
+
+        np.testing.assert_allclose(batch[k], single, rtol=0, atol=1e-12)
+
+def test_log_probability_batch_matches_residuals():
+    rng = np.random.RandomState(42)
+    times = np.linspace(-0.2, 2.2, 5000)
+    xcenters = 15.0 + 0.05 * rng.randn(times.size)
+    ycenters = 15.0 + 0.05 * rng.randn(times.size)
+
+    params = model_params(intercept=1.0, slope=1e-4)
+    fluxes = skywalker.compute_full_model_normal(params.copy(), times) \
+                * (1.0 + 1e-2 * (xcenters - 15.0)) + 1e-4 * rng.randn(times.size)
+    flux_errs = np.full(times.size, 1e-4)
+
+    # Outliers that the 10-sigma clipping of the sensitivity map has to catch
+    fluxes[[0, 1000, 2500, -1]] *= 1.05
+
+    knots = bliss.createGrid(xcenters, ycenters, 0.01, 0.01)
+    nearIndices = bliss.regularGridIndices(xcenters, ycenters, knots, 0.01, 0.01)
+    operator = bliss.BLISSOperator(xcenters, ycenters, knots, nearIndices, 0.01, 0.01)
+
+    param_names = ['deltaTc', 'edepth', 'aprs', 'tdepth']
+    theta = np.array([[0.05, 1e-3, 8.0, 0.01], [0.04, 2e-3, 7.8, 0.011], [0.06, 5e-4, 8.3, 0.009]])
+    for name in param_names: params[name].set(min=-1.0, max=100.0)
+
+    log_prob = skywalker.log_probability_batch(theta, param_names, params, times, fluxes, 
+                                               flux_errs, sensitivity_operator=operator)
+
+    for k, row in enumerate(theta):
+        for name, value in zip(param_names, row): params[name].value = value
+        residuals = skywalker.residuals_func(params.copy(), times, xcenters, ycenters, fluxes, 
+                                             flux_errs, None, method='bliss', fit_function='normal', 
+                                             bliss_operator=operator)
+
+        np.testing.assert_allclose(log_prob[k], -0.5*np.sum(residuals**2), rtol=1e-10)
+
+@pytest.mark.parametrize('nCores', [1, 2])
+def test_bliss_bin_size_sweep(nCores):
+    rng = np.random.RandomState(42)
+    times = np.linspace(-0.2, 2.2, 3000)
+    xcenters = 15.0 + 0.05 * rng.randn(times.size)
+    ycenters = 15.0 + 0.05 * rng.randn(times.size)
+
+    params = model_params(intercept=1.0, slope=1e-4)
+    fluxes = skywalker.compute_full_model_normal(params.copy(), times) \
+                * (1.0 + 1e-2 * (xcenters - 15.0)) + 1e-4 * rng.randn(times.size)
+    flux_errs = np.full(times.size, 1e-4)
+
+    for name in params: params[name].vary = name in ['tdepth', 'edepth']
+
+    bin_sizes = [0.01, (0.02, 0.01), 0.05]
+    best_bin_size, results = skywalker.bliss_bin_size_sweep(params, times, xcenters, ycenters, 
+                                                            fluxes, flux_errs, bin_sizes, 
+                                                            nCores=nCores)
+
+    assert list(results['x_bin_size']) == [0.01, 0.02, 0.05]
+    assert list(results['y_bin_size']) == [0.01, 0.01, 0.05]
+    assert np.all(np.isfinite(results['chisq']))
+
+    best = results['bic'].idxmin()
+    assert best_bin_size == (results['x_bin_size'][best], results['y_bin_size'][best])
+
+    # The BIC counts every occupied knot as a free parameter
+    np.testing.assert_allclose(results['bic'], results['chisq'] 
+                               + (2 + results['n_knots']) * np.log(times.size))
+
+def explicit_harmonics(phase, cos_amps, sin_amps):
+    return sum(cos_amp*np.cos(k*phase) + sin_amp*np.sin(k*phase) 
+                for k, (cos_amp, sin_amp) in enumerate(zip(cos_amps, sin_amps), 1))
+
+@pytest.mark.parametrize('n_harm', [1, 2, 5])
+def test_harmonic_phase_curve(n_harm):
+    times = np.linspace(-0.2, 6.2, 20000)
+    rng = np.random.RandomState(42)
+    cos_amps, sin_amps = 1e-3 * rng.randn(2, n_harm)
+
+    # Changing t_secondary reuses the cached basis of `times`
+    for t_secondary in [1.0, 1.003, 0.97]:
+        phase = 2*np.pi / 2.0 * (times - t_secondary)
+        cos_phase, sin_phase = models.phase_basis(times, 2.0, t_secondary)
+
+        np.testing.assert_allclose(cos_phase, np.cos(phase), rtol=0, atol=1e-12)
+        np.testing.assert_allclose(sin_phase, np.sin(phase), rtol=0, atol=1e-12)
+        np.testing.assert_allclose(models.harmonic_phase_curve(cos_phase, sin_phase, cos_amps, sin_amps), 
+                                   explicit_harmonics(phase, cos_amps, sin_amps), rtol=0, atol=1e-13)
+
+    params = model_params(**{name: amp for k in range(n_harm) 
+                                for name, amp in [('cosAmp{}'.format(k+1), cos_amps[k]), 
+                                                  ('sinAmp{}'.format(k+1), sin_amps[k])]})
+    del params['cosAmp'], params['cosPhase']
+    phase_curve = models.phase_curve_func(params, times, 0.0)
+
+    # Without deltaEc, the eclipse is at init_t0 + period / 2
+    expected = explicit_harmonics(2*np.pi / 2.0 * (times - 1.0), cos_amps, sin_amps)
+    np.testing.assert_allclose(phase_curve, expected + 1.0 - expected.min(), rtol=0, atol=1e-13)
+
+def test_phase_curve_precedence():
+    times = np.linspace(-0.2, 6.2, 2000)
+    params = model_params(cosAmp1=5e-3, sinAmp1=5e-3)
+    reference = model_params()
+
+    # cosAmp/cosPhase wins over the numbered harmonics, as before they were generalized
+    np.testing.assert_array_equal(models.phase_curve_func(params, times, 0.0), 
+                                  models.phase_curve_func(reference, times, 0.0))
+
+    values = models.batch_parameter_values(np.zeros((1, 0)), [], params)
+    np.testing.assert_allclose(models.phase_curve_batch(values, times, 0.0)[0], 
+                               models.phase_curve_func(reference, times, 0.0), rtol=0, atol=1e-15)
@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+
+from lmfit import Parameters
+
+from .. import models
+from .. import pld
+
+def synthetic_pld(n_frames=5000, seed=0):
+    rng = np.random.RandomState(seed)
+    pld_intensities = pld.normalize_pld(np.abs(1 + 0.1 * rng.randn(9, n_frames)))
+    physical_model = 1 - 0.01 * np.exp(-((np.arange(n_frames) - n_frames / 2) / 300.)**2)
+    flux_errs = 1e-3 * (1 + rng.rand(n_frames))
+
+    return rng, pld_intensities, physical_model, flux_errs
+
+@pytest.mark.parametrize('exact', [False, True])
+@pytest.mark.parametrize('basis_kwargs', [dict(do_pca=False, do_std=False),
+                                          dict(do_pca=False, do_std=True),
+                                          dict(pca_cut=True)])
+def test_pld_solver_rank_deficient_basis(basis_kwargs, exact):
+    # The normalized pixels sum to one, which duplicates the unity row
+    rng, pld_intensities, physical_model, flux_errs = synthetic_pld()
+    basis = models.compute_pld_vectors(None, pld_intensities, **basis_kwargs)
+
+    systematics = np.dot(1e-3 * rng.randn(basis.shape[0]), basis)
+    fluxes = physical_model * (systematics + 1 - systematics.mean())
+    fluxes += flux_errs * rng.randn(fluxes.size)
+
+    solver = pld.PLDSolver(basis, flux_errs, exact=exact)
+    sensitivity_map = solver(fluxes / physical_model, physical_model)
+
+    weights = (physical_model if exact else 1.0) / flux_errs
+    coeffs = np.linalg.lstsq((basis * weights).T, fluxes / physical_model * weights, rcond=None)[0]
+
+    assert np.all(np.isfinite(solver.coeffs))
+    np.testing.assert_allclose(sensitivity_map, np.dot(coeffs, basis), atol=1e-10)
+
+def test_pld_lstsq_rank_deficient_basis():
+    rng, pld_intensities, physical_model, flux_errs = synthetic_pld()
+    features = pld.pld_features(pld_intensities)
+    design = np.vstack([features, np.ones(features.shape[1])])
+
+    fluxes = np.dot(1e-2 * rng.randn(design.shape[0]), design) + flux_errs * rng.randn(design.shape[1])
+
+    coeffs = pld.pld_lstsq(pld_intensities, fluxes, flux_errs, block_size=700)
+    reference = np.linalg.lstsq((design / flux_errs).T, fluxes / flux_errs, rcond=None)[0]
+
+    np.testing.assert_allclose(pld.pld_dot(coeffs, pld_intensities, block_size=700),
+                               np.dot(reference, design), atol=1e-10)
+
+def test_streaming_pld_params():
+    rng, pld_intensities, physical_model, flux_errs = synthetic_pld()
+    basis_kwargs = dict(do_pca=False, do_std=False)
+
+    dense_params, basis = models.add_pld_params(Parameters(), physical_model, pld_intensities, 
+                                                **basis_kwargs)
+    stream_params, raw = models.add_pld_params(Parameters(), physical_model, pld_intensities, 
+                                               streaming=True, **basis_kwargs)
+
+    assert raw is pld_intensities
+    np.testing.assert_array_equal(models.compute_pld_vectors(None, pld_intensities, streaming=True, 
+                                                             **basis_kwargs), raw)
+    assert list(stream_params.keys()) == list(dense_params.keys())
+
+    residuals = physical_model * (1 + 1e-4 * rng.randn(physical_model.size))
+    sensitivity_maps = [models.compute_sensitivity_map(params, 'pld', None, None, residuals, None, 
+                                                       None, None, None, None, None, intensities, 
+                                                       physical_model)
+                            for params, intensities in [(dense_params, basis), (stream_params, raw)]]
+
+    # Same fit of the rank-deficient basis, up to the null space of the coefficients
+    np.testing.assert_allclose(sensitivity_maps[1], sensitivity_maps[0], atol=1e-10)
+
+    with pytest.raises(ValueError):
+        models.add_pld_params(Parameters(), physical_model, pld_intensities, streaming=True)
+
+@pytest.mark.parametrize('basis_kwargs', [dict(do_pca=False, do_std=False), dict(do_pca=False), 
+                                          dict(), dict(pca_cut=True)])
+def test_pld_basis(basis_kwargs, tmpdir):
+    rng, pld_intensities, physical_model, flux_errs = synthetic_pld()
+    reference = models.compute_pld_vectors(None, pld_intensities, **basis_kwargs)
+
+    basis = pld.PLDBasis(block_size=700, **basis_kwargs)
+    np.testing.assert_allclose(basis.fit_transform(pld_intensities), reference, rtol=0, atol=1e-10)
+
+    # A reloaded basis applies the same transform to a new segment without refitting
+    filename = str(tmpdir.join('pld_basis.pkl'))
+    basis.save(filename)
+    segment = synthetic_pld(n_frames=1000, seed=1)[1]
+
+    np.testing.assert_array_equal(pld.PLDBasis.load(filename).transform(segment), 
+                                  basis.transform(segment))
+
+def test_incremental_pld_basis():
+    rng, pld_intensities, physical_model, flux_errs = synthetic_pld()
+
+    batch = pld.PLDBasis().fit(pld_intensities)
+    incremental = pld.PLDBasis(incremental=True, block_size=700).fit(pld_intensities)
+
+    np.testing.assert_allclose(incremental.scaler.mean_, batch.scaler.mean_, rtol=1e-12)
+    np.testing.assert_allclose(incremental.scaler.var_, batch.scaler.var_, rtol=1e-10)
+
+    # The PCA components may differ in sign, but both bases span the same space
+    design = pld.pld_features(pld_intensities)
+    fluxes = np.dot(1e-2 * rng.randn(design.shape[0]), design) + flux_errs * rng.randn(design.shape[1])
+    fits = [np.dot(np.linalg.lstsq(basis.T, fluxes, rcond=None)[0], basis) 
+                for basis in [batch.transform(pld_intensities), incremental.transform(pld_intensities)]]
+
+    np.testing.assert_allclose(fits[1], fits[0], rtol=0, atol=1e-10)
+
+    with pytest.raises(ValueError):
+        pld.PLDBasis(incremental=True, do_ica=True)
+
+    with pytest.raises(ValueError):
+        pld.PLDBasis().transform(pld_intensities)
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_ingest_pld(dtype, tmpdir):
+    rng = np.random.RandomState(42)
+    raw = np.abs(1 + 0.1 * rng.randn(3, 3, 5000))
+    keep = rng.rand(raw.shape[-1]) > 0.1
+
+    # The raw pixels as they come out of `extractData`: memory-mapped, (3, 3, N)
+    filename = str(tmpdir.join('pld_intensities.npy'))
+    np.save(filename, raw.astype(dtype))
+    mmapped = np.load(filename, mmap_mode='r')
+
+    reference = pld.normalize_pld(np.array([pix[keep] for pix in raw.reshape(9, -1)], dtype=dtype))
+
+    for keep_inds in [keep, np.flatnonzero(keep)]:
+        ingested = pld.ingest_pld(mmapped, keep_inds, dtype=dtype, block_size=700)
+
+        assert ingested.dtype == dtype
+        np.testing.assert_allclose(ingested, reference, rtol=10 * np.finfo(dtype).eps)
+
+    np.testing.assert_allclose(pld.ingest_pld(raw.reshape(9, -1), dtype=dtype), 
+                               pld.normalize_pld(raw.reshape(9, -1).astype(dtype)), 
+                               rtol=10 * np.finfo(dtype).eps)
@@ -2,9 +2,11 @@ from scipy import spatial
 from sklearn.externals import joblib
 from pylab import *;
 
+from time import time
 from tqdm import tqdm
 
 from . import bliss
+from . import cache
 from . import krdata as kr
 
 import math
@@ -17,9 +19,11 @@ zero = 0.0
 def extractData(file, flux_key='phots', time_key='times', flux_err_key='noise',
                 eff_width_key = 'npix', pld_coeff_key = 'pld', 
                 ycenter_key='ycenters', xcenter_key='xcenters', 
-                ywidth_key='ywidths', xwidth_key='xwidths'):
+                ywidth_key='ywidths', xwidth_key='xwidths', mmap_mode=None):
     
-    group = joblib.load(file)
+    # mmap_mode = 'r' leaves the (uncompressed) arrays on disk, e.g. for 
+    #   `pld.ingest_pld`
+    group = joblib.load(file, mmap_mode=mmap_mode)
     
     fluxes = group[flux_key].flatten()
     times = group[time_key].flatten()
@@ -74,7 +78,13 @@ def setup_inputs_from_file(dataDir, x_bin_size=0.1, y_bin_size=0.1,
                         flux_err_key='noise', eff_width_key = 'npix', 
                         pld_coeff_key = 'pld', ycenter_key='ycenters', 
                         xcenter_key='xcenters',ywidth_key='ywidths', 
-                        xwidth_key='xwidths', method=None):
+                        xwidth_key='xwidths', method=None, regular_grid=False,
+                        quadtree_min_frames=None, np_bin_size=None, 
+                        cache_dir=None, cache_max_bytes=2**30, 
+                        krdata_cores=1, krdata_sparse=False, n_nbr=100, 
+                        expansion=1000, kdtree_workers=-1, 
+                        krdata_memmap_dir=None, krdata_block_size=100000, 
+                        krdata_weight_tol=None, mmap_mode=None):
     """
     Description:
         This function takes in the filename of the data (stored with 
@@ -99,6 +109,45 @@ def setup_inputs_from_file(dataDir, x_bin_size=0.1, y_bin_size=0.1,
         reject x-outliers
         ySigmaRange (float): relative distance in gaussian sigma space to 
         reject y-outliers
+        regular_grid (bool): locate the nearest BLISS knots with floor 
+        arithmetic on the regular knot grid instead of a KDTree query per 
+        point
+        quadtree_min_frames (int or None): if set, build an adaptive quadtree 
+        BLISS grid (see `bliss.createQuadtreeGrid`) that only refines cells 
+        holding enough frames, down to x_bin_size by y_bin_size; the cells 
+        then have variable sizes, so pass x_bin_size = y_bin_size = None to 
+        the fitting routines
+        np_bin_size (float or None): if set, grid BLISS in 3-D over (x, y, 
+        sqrt(npix)) with this spacing along sqrt(npix) (see 
+        `bliss.createVoxelGrid`); the sensitivity map is then computed with 
+        a `bliss.BLISS3DOperator` passed as `bliss_operator`
+        cache_dir (str or None): directory of an on-disk cache for the BLISS 
+        knots and nearIndices; repeated calls with the same centers, 
+        keep_inds and bin sizes load them instead of recomputing them
+        cache_max_bytes (int): maximum size of `cache_dir` on disk; the least 
+        recently used entries are removed first
+        krdata_cores (int): number of processes used to compute the KRDATA 
+        gaussian weights (see `krdata.gaussian_weights_shared`)
+        krdata_sparse (bool): return the KRDATA neighbours and weights as a 
+        single sparse operator in `gw_kdtree` (with `ind_kdtree` = None); see 
+        `krdata.kernel_regression_operator`
+        n_nbr (int): number of nearest neighbours per point for KRDATA
+        expansion (float): scale factor applied to the (x, y, npix) points 
+        before building the KRDATA KDTree
+        kdtree_workers (int): number of threads for the KRDATA KDTree query 
+        (-1 uses all of them)
+        krdata_memmap_dir (str or None): if set, store the KRDATA neighbours 
+        and weights in memory-mapped files in this directory and stream over 
+        them in blocks (see `krdata.MemmapKernelRegression`); `gw_kdtree` is 
+        then that object and `ind_kdtree` = None
+        krdata_block_size (int): number of rows per block in the streaming 
+        KRDATA mode
+        krdata_weight_tol (float or None): if set, truncate the neighbours of 
+        each point once their cumulative weight reaches 1 - krdata_weight_tol 
+        and return the result as a sparse operator in `gw_kdtree` (with 
+        `ind_kdtree` = None); see `krdata.adaptive_kernel_regression_operator`
+        mmap_mode (str or None): passed to `joblib.load`; with 'r' the raw 
+        pld_intensities stay memory-mapped for `pld.ingest_pld`
     Returns:
         xcenters (nDarray): X positions for centering analysis
         ycenters (nDarray): Y positions for centering analysis
@@ -125,7 +174,8 @@ def setup_inputs_from_file(dataDir, x_bin_size=0.1, y_bin_size=0.1,
                                 ycenter_key = ycenter_key, 
                                 xcenter_key = xcenter_key, 
                                 ywidth_key = ywidth_key, 
-                                xwidth_key = xwidth_key)
+                                xwidth_key = xwidth_key, 
+                                mmap_mode = mmap_mode)
 
     fluxes, times, flux_errs, npix, pld_intensities, \
         xcenters, ycenters, xwidths, ywidths = extracted_data
@@ -137,34 +187,101 @@ def setup_inputs_from_file(dataDir, x_bin_size=0.1, y_bin_size=0.1,
                                     f_sigma_cutoff=fSigmaRange)
     if 'bliss' in method.lower():
         print('Setting up BLISS')
-        knots = bliss.createGrid(xcenters[keep_inds], ycenters[keep_inds], 
-                                    x_bin_size, y_bin_size)
+        cached = None
+        if cache_dir is not None:
+            bliss_cache = cache.ArtifactCache(cache_dir, 
+                                                max_bytes=cache_max_bytes)
+            # The voxel grid also depends on the noise pixels
+            key_arrays = [xcenters, ycenters, keep_inds]
+            if np_bin_size is not None: key_arrays.append(npix)
+            
+            cache_key = cache.artifact_key(*key_arrays, 
+                                            x_bin_size=x_bin_size, 
+                                            y_bin_size=y_bin_size, 
+                                            regular_grid=regular_grid, 
+                                    quadtree_min_frames=quadtree_min_frames, 
+                                            np_bin_size=np_bin_size)
+            cached = bliss_cache.load(cache_key, ['knots', 'nearIndices'])
+        
+        if cached is not None:
+            print('Loading BLISS knots from {}'.format(cache_dir))
+            knots = cached['knots']
+            nearIndices = cached['nearIndices']
+        elif np_bin_size is not None:
+            knots, nearIndices = bliss.createVoxelGrid(xcenters[keep_inds],
+                                            ycenters[keep_inds], 
+                                            npix[keep_inds], x_bin_size, 
+                                            y_bin_size, np_bin_size)
+        elif quadtree_min_frames is not None:
+            knots, nearIndices = bliss.createQuadtreeGrid(xcenters[keep_inds],
+                                            ycenters[keep_inds], 
+                                            x_bin_size, y_bin_size, 
+                                            minFrames=quadtree_min_frames)
+        else:
+            knots = bliss.createGrid(xcenters[keep_inds], ycenters[keep_inds],
+                                        x_bin_size, y_bin_size)
+            
+            if regular_grid:
+                nearIndices = bliss.regularGridIndices(xcenters[keep_inds], 
+                                                ycenters[keep_inds], knots, 
+                                                x_bin_size, y_bin_size)
+            else:
+                knotTree = spatial.cKDTree(knots)
+                nearIndices = bliss.nearestIndices(xcenters[keep_inds], 
+                                                ycenters[keep_inds], knotTree)
+        
+        if cached is None and cache_dir is not None:
+            bliss_cache.save(cache_key, knots=knots, nearIndices=nearIndices)
         
         print('BLISS will use a total of {} knots'.format(len(knots)))
-        knotTree = spatial.cKDTree(knots)
-        nearIndices = bliss.nearestIndices(xcenters[keep_inds], 
-                                            ycenters[keep_inds], knotTree)
         
         ind_kdtree = None
         gw_kdtree = None
     elif 'krdata' in method.lower():
         print('Setting up KRDATA')
-        n_nbr = 100
-        expansion = 1000
-
         xpos = xcenters[keep_inds] - np.median(xcenters[keep_inds])
         ypos = (ycenters[keep_inds] - np.median(ycenters[keep_inds]))/0.7
         np0 = sqrt(npix[keep_inds])
         np0 = (np0 - median(np0))
         
         points = np.transpose([xpos, ypos, np0])
+        
+        start = time()
         kdtree = spatial.cKDTree(points * expansion)
-
-        ind_kdtree = kdtree.query(kdtree.data, n_nbr+1)[1][:,1:]
-        gw_kdtree = kr.gaussian_weights_and_nearest_neighbors(xpos = xpos,
+        print('KDTree build took {:.2f} seconds'.format(time() - start))
+        
+        if krdata_memmap_dir is not None:
+            start = time()
+            gw_kdtree = kr.MemmapKernelRegression(krdata_memmap_dir, 
+                                                  len(points), n_nbr, 
+                                          block_size=krdata_block_size)
+            gw_kdtree.fill(kdtree, xpos, ypos, np0, workers=kdtree_workers)
+            print('KRDATA streaming setup took {:.2f} seconds'.format(
+                                                            time() - start))
+            ind_kdtree = None
+        else:
+            start = time()
+            ind_kdtree = kr.query_nearest_neighbors(kdtree, kdtree.data, 
+                                                    n_nbr, 
+                                                    workers=kdtree_workers)
+            print('KDTree query took {:.2f} seconds'.format(time() - start))
+            
+            gw_kdtree = kr.gaussian_weights_and_nearest_neighbors(xpos = xpos,
                                                             ypos = ypos,
                                                             npix = np0,
-                                                            inds = ind_kdtree)
+                                                            inds = ind_kdtree,
+                                                        nCores = krdata_cores)
+        
+        if krdata_weight_tol is not None and ind_kdtree is not None:
+            gw_kdtree = kr.adaptive_kernel_regression_operator(ind_kdtree, 
+                                                               gw_kdtree, 
+                                            weight_tol=krdata_weight_tol)
+            ind_kdtree = None
+            print('KRDATA will use {:.1f} neighbours per point on average'
+                    ''.format(gw_kdtree.nnz / gw_kdtree.shape[0]))
+        elif krdata_sparse and ind_kdtree is not None:
+            gw_kdtree = kr.kernel_regression_operator(ind_kdtree, gw_kdtree)
+            ind_kdtree = None
         
         knots = None
         nearIndices = None